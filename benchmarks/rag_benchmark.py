@@ -0,0 +1,312 @@
+"""Offline end-to-end benchmark of `rag()` and the chat flow.
+
+Runs the real chain against local stand-ins: hash-seeded embeddings, the
+embedded `LocalVectorIndex` (same filter semantics as Pinecone) and a
+scripted streaming chat model. Questions and dialog history come from
+data/conversations.json. Reports per-stage latency (from the tracer),
+allocations and throughput across top_k, history length and document count.
+
+    python benchmarks/rag_benchmark.py --top-k 5 20 --history 0 10 --documents 200 2000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import statistics
+from pathlib import Path
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+SECRETS = """
+OPENAI_API_KEY = "benchmark"
+ANTHROPIC_API_KEY = "benchmark"
+LANGCHAIN_API_KEY = "benchmark"
+PINECONE_API_KEY = "benchmark"
+INDEX_NAME = "benchmark"
+MODEL_OPTION = ["{model}"]
+
+[prompts]
+rag_contextualize_q_system_prompt = "benchmark_contextualize_q_system_prompt"
+rag_system_prompt = "benchmark_system_prompt"
+snapshot_path = ".cache/prompts.json"
+refresh_interval = 86400
+
+[rag]
+top_k = 20
+
+[vector_store]
+backend = "local"
+dimension = {dimension}
+
+[history]
+url = "sqlite:///.cache/history.sqlite3"
+
+[tracing]
+enabled = true
+"""
+
+TAG = "benchmark"
+# pipeline stages reported per scenario, as named by the tracer
+STAGES = [
+    "rag.setup",
+    "question_rewriter",
+    "embedding",
+    "retrieval",
+    "context_pack",
+    "llm.answer",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top-k", type=int, nargs="+", default=[5, 20])
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 4, 10],
+                        help="dialog turns already in the session")
+    parser.add_argument("--documents", type=int, nargs="+", default=[200, 2000],
+                        help="pages in the vector index")
+    parser.add_argument("--turns", type=int, default=10, help="turns per scenario")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8],
+                        help="simultaneous chats in the throughput run")
+    parser.add_argument("--model", default="gpt-4o-2024-08-06")
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--answer-tokens", type=int, default=100)
+    parser.add_argument("--embedding-latency", type=float, default=0.02)
+    parser.add_argument("--dimension", type=int, default=256)
+    parser.add_argument("--output", help="also write the results as JSON")
+    return parser.parse_args()
+
+
+def load_fixtures():
+    with open(REPO_ROOT / "data" / "conversations.json", encoding="utf-8") as f:
+        conversations = json.load(f)
+
+    questions = [
+        message["content"]
+        for conversation in conversations
+        for message in conversation["messages"]
+        if message["role"] == "user"
+    ]
+    turns = [
+        (conversation["messages"][i]["content"], conversation["messages"][i + 1]["content"])
+        for conversation in conversations
+        for i in range(len(conversation["messages"]) - 1)
+        if conversation["messages"][i]["role"] == "user"
+    ]
+    return questions, turns
+
+
+def build_index(path, pages, embeddings, turns, dimension):
+    from managers import LocalVectorIndex
+
+    index = LocalVectorIndex(path, dimension=dimension)
+    batch = []
+    for i in range(pages):
+        question, answer = turns[i % len(turns)]
+        content = f"{question} {answer} " * 4 + f"(page {i})"
+        batch.append((
+            f"page-{i}",
+            embeddings.embed_query(content),
+            {"tag": TAG, "name": f"document-{i // 20}", "page": i % 20, "content": content},
+        ))
+        if len(batch) == 200:
+            index.upsert(batch, namespace=TAG)
+            batch = []
+    if batch:
+        index.upsert(batch, namespace=TAG)
+    return index
+
+
+def new_session(session_id, history, turns):
+    from langchain_core.messages import AIMessage, HumanMessage
+    from managers import HistoryManager
+
+    messages = []
+    for i in range(history):
+        question, answer = turns[i % len(turns)]
+        messages += [HumanMessage(content=question), AIMessage(content=answer)]
+    if messages:
+        HistoryManager.get_session_history(session_id).add_messages(messages)
+    return session_id
+
+
+def run_scenario(R, tracer, args, questions, turns, documents, top_k, history):
+    tracer.reset()
+    latencies, ttfts, peaks, answer_tokens = [], [], [], 0
+
+    tracemalloc.start()
+    for turn in range(args.turns):
+        session_id = new_session(
+            f"benchmark-{documents}-{top_k}-{history}-{turn}-{time.time_ns()}", history, turns)
+        question = questions[turn % len(questions)]
+
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        started_at = time.perf_counter()
+        first_token_at = None
+
+        _, stream = R.rag(question, args.model, session_id=session_id, namespace=TAG)
+        for chunk in stream:
+            if answer_chunk := chunk.get("answer"):
+                first_token_at = first_token_at or time.perf_counter()
+                answer_tokens += len(answer_chunk)
+
+        latencies.append((time.perf_counter() - started_at) * 1000)
+        ttfts.append(((first_token_at or time.perf_counter()) - started_at) * 1000)
+        peaks.append((tracemalloc.get_traced_memory()[1] - baseline) / 1024)
+    tracemalloc.stop()
+
+    summary = tracer.summary()
+    return {
+        "documents": documents,
+        "top_k": top_k,
+        "history": history,
+        "turns": args.turns,
+        "ttft_p50_ms": statistics.median(ttfts),
+        "latency_p50_ms": statistics.median(latencies),
+        "latency_p95_ms": percentile(latencies, 95),
+        "peak_alloc_kib": statistics.median(peaks),
+        "answer_tokens_per_s": answer_tokens / (sum(latencies) / 1000),
+        "stages_p50_ms": {
+            stage: summary[stage]["p50"] for stage in STAGES if stage in summary
+        },
+    }
+
+
+def run_throughput(R, args, questions, turns, concurrency):
+    """Turns per second with `concurrency` script threads running the chat flow."""
+    from managers import UsageMeter
+
+    def chat(worker):
+        session_id = new_session(f"throughput-{worker}-{time.time_ns()}", 2, turns)
+        for turn in range(args.turns):
+            # the same sequence as chat.py
+            with UsageMeter.track():
+                _, stream = R.run_async(R.arag(
+                    questions[(worker + turn) % len(questions)],
+                    model_id=args.model,
+                    session_id=session_id,
+                    namespace=TAG
+                ))
+                for chunk in R.iterate_async(stream):
+                    chunk.get("answer")
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(chat, range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+    return {
+        "concurrency": concurrency,
+        "turns": concurrency * args.turns,
+        "seconds": elapsed,
+        "turns_per_s": concurrency * args.turns / elapsed,
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def print_results(results):
+    print(f"{'docs':>6} {'top_k':>5} {'hist':>4} {'ttft':>8} {'p50':>8} {'p95':>8} "
+          f"{'alloc KiB':>10} {'tok/s':>7}  stages p50 (ms)")
+    for row in results["scenarios"]:
+        stages = " ".join(f"{stage}={ms:.1f}" for stage, ms in row["stages_p50_ms"].items())
+        print(f"{row['documents']:>6} {row['top_k']:>5} {row['history']:>4} "
+              f"{row['ttft_p50_ms']:>8.1f} {row['latency_p50_ms']:>8.1f} "
+              f"{row['latency_p95_ms']:>8.1f} {row['peak_alloc_kib']:>10.0f} "
+              f"{row['answer_tokens_per_s']:>7.0f}  {stages}")
+
+    print()
+    print(f"{'chats':>6} {'turns':>6} {'seconds':>8} {'turns/s':>8}")
+    for row in results["throughput"]:
+        print(f"{row['concurrency']:>6} {row['turns']:>6} {row['seconds']:>8.2f} "
+              f"{row['turns_per_s']:>8.2f}")
+
+
+def main():
+    args = parse_args()
+    questions, turns = load_fixtures()
+
+    # streamlit reads .streamlit/secrets.toml from the working directory
+    workspace = tempfile.mkdtemp(prefix="rag-benchmark-")
+    os.makedirs(os.path.join(workspace, ".streamlit"))
+    with open(os.path.join(workspace, ".streamlit", "secrets.toml"), "w") as f:
+        f.write(SECRETS.format(model=args.model, dimension=args.dimension))
+    os.chdir(workspace)
+    # bare-mode runs warn about the missing script run context on every call
+    os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+
+    import langchain_conversational_rag as R
+    from managers import Tracer
+    from benchmarks.stubs import HashEmbeddings, ScriptedChatModel
+
+    def chat_model(*_, model=None, max_tokens=None, **kwargs):
+        return ScriptedChatModel(
+            model_name=model,
+            ttft=args.ttft,
+            tokens_per_second=args.tokens_per_second,
+            answer_tokens=min(args.answer_tokens, max_tokens or args.answer_tokens),
+        )
+
+    def embeddings(*_, **kwargs):
+        return HashEmbeddings(dimension=args.dimension, latency=args.embedding_latency)
+
+    def unavailable(*_, **kwargs):
+        raise ConnectionError("offline benchmark")
+
+    indexes = {
+        documents: build_index(
+            os.path.join(workspace, f"vectors-{documents}"),
+            documents,
+            HashEmbeddings(dimension=args.dimension),
+            turns,
+            args.dimension
+        )
+        for documents in args.documents
+    }
+
+    results = {"scenarios": [], "throughput": []}
+    with mock.patch("managers.model_registry.ChatOpenAI", chat_model), \
+            mock.patch("managers.model_registry.ChatAnthropic", chat_model), \
+            mock.patch.object(R, "OpenAIEmbeddings", embeddings), \
+            mock.patch("managers.prompt_manager.hub.pull", unavailable):
+        get_search_kwargs = R.get_search_kwargs
+        tracer = Tracer.get_shared()
+
+        for documents, index in indexes.items():
+            for top_k in args.top_k:
+                R.get_chain_registry().clear()
+                with mock.patch.object(R, "get_index", lambda name: index), \
+                        mock.patch.object(
+                            R,
+                            "get_search_kwargs",
+                            lambda names, namespace=None: {**get_search_kwargs(names, namespace), "k": top_k}
+                        ):
+                    for history in args.history:
+                        results["scenarios"].append(run_scenario(
+                            R, tracer, args, questions, turns, documents, top_k, history))
+
+        R.get_chain_registry().clear()
+        largest = indexes[max(indexes)]
+        with mock.patch.object(R, "get_index", lambda name: largest):
+            for concurrency in args.concurrency:
+                results["throughput"].append(
+                    run_throughput(R, args, questions, turns, concurrency))
+
+    print_results(results)
+    if args.output:
+        with open(os.path.join(REPO_ROOT, args.output) if not os.path.isabs(args.output)
+                  else args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
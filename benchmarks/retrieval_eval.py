@@ -0,0 +1,230 @@
+"""Retrieval quality vs. latency and prompt size for candidate configurations.
+
+Runs a labeled question set through the configured retriever (the app's
+secrets, index and API keys, so run it from the directory holding
+`.streamlit/secrets.toml`) and through candidates that change top_k,
+reranking, hybrid search and chunking. Reports recall@k and MRR over the
+expected pages next to retrieval latency and the tokens of the retrieved
+and packed context.
+
+The labeled set is JSONL, one question per line:
+
+    {"question": "...", "tag": "...", "expected": [{"name": "...", "page": 3}]}
+
+An expected entry without "page" matches any page of the document, and an
+optional "documents" list restricts retrieval like the chat page's document
+selection. Chunked candidates (`--chunk-tokens` > 0) are embedded into a
+temporary local index from `--corpus`: page records as JSONL
+(`{tag, name, page, content}`) or a directory of PDFs loaded into `--tag`.
+Tags are searched in the namespaces of `--user`, as on the chat page.
+
+    python benchmarks/retrieval_eval.py labeled.jsonl --user <username> --top-k 5 10 20 --rerank off on
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import itertools
+import statistics
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import PyPDF2
+import streamlit as st
+
+import langchain_conversational_rag as R
+from managers import EmbeddingBatcher, LocalVectorIndex, PineconeManager
+from managers.context_packer import PASSAGE_PATTERN
+from managers.ingestion import extract_page_range, page_records
+from managers.text_utils import count_tokens
+
+SWITCHES = {"off": False, "on": True}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("labeled", help="JSONL file of labeled questions")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--rerank", choices=SWITCHES, nargs="+", default=["off", "on"])
+    parser.add_argument("--hybrid", choices=SWITCHES, nargs="+", default=["off"])
+    parser.add_argument("--chunk-tokens", type=int, nargs="+", default=[0],
+                        help="0 evaluates the page index; other sizes need --corpus")
+    parser.add_argument("--corpus", help="page records (.jsonl) or a directory of PDFs")
+    parser.add_argument("--tag", help="tag of the PDFs in --corpus")
+    parser.add_argument("--user", required=True,
+                        help="owner of the labeled questions' tags")
+    parser.add_argument("--model", default=st.secrets.MODEL_OPTION[0],
+                        help="model whose context budget packs the retrieved pages")
+    parser.add_argument("--output", help="also write the results as JSON")
+    return parser.parse_args()
+
+
+def load_labeled(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_corpus(path, tag):
+    if os.path.isdir(path):
+        pages = []
+        for pdf in sorted(Path(path).glob("*.pdf")):
+            page_count = len(PyPDF2.PdfReader(pdf).pages)
+            pages += page_records(tag, pdf.stem, extract_page_range(str(pdf), 0, page_count))
+        return pages
+
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def chunk_page(page, chunk_tokens):
+    """Split a page at sentence boundaries into chunks of about `chunk_tokens`."""
+    chunks, current, current_tokens = [], "", 0
+    for passage in PASSAGE_PATTERN.split(page["content"]):
+        tokens = count_tokens(passage)
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        current += passage
+        current_tokens += tokens
+    if current.strip():
+        chunks.append(current)
+    return [{**page, "content": chunk} for chunk in chunks]
+
+
+def build_chunk_index(pages, chunk_tokens, user, batch_size=64):
+    """Embed the chunked corpus into a temporary local index, one namespace
+    per tag of `user`."""
+    chunks = [chunk for page in pages for chunk in chunk_page(page, chunk_tokens)]
+    index = LocalVectorIndex(
+        tempfile.mkdtemp(prefix=f"retrieval-eval-{chunk_tokens}-"),
+        dimension=st.secrets.get("vector_store", {}).get("dimension", 1536)
+    )
+    # no cache: chunk vectors must not evict the app's cached query embeddings
+    batcher = EmbeddingBatcher()
+
+    for i in range(0, len(chunks), batch_size):
+        batch = chunks[i: i + batch_size]
+        vectors, _, _ = batcher.embed([chunk["content"] for chunk in batch])
+        for tag, group in itertools.groupby(
+                zip(batch, vectors), key=lambda item: item[0]["tag"]):
+            index.upsert([
+                (PineconeManager.generate_unique_id(chunk["name"], chunk["content"]), vector, chunk)
+                for chunk, vector in group
+            ], namespace=PineconeManager.tag_namespace(tag, user))
+    print(f"Indexed {len(pages)} pages as {len(chunks)} chunks of ~{chunk_tokens} tokens")
+    return index
+
+
+def search_kwargs(example, top_k, rerank):
+    kwargs = R.get_search_kwargs(example.get("documents"), example.get("namespace"))
+    if rerank:
+        kwargs["k"] = max(top_k, st.secrets.rag.get("rerank", {}).get("fetch_k", 50))
+    else:
+        kwargs["k"] = top_k
+    return kwargs
+
+
+def relevance(example, docs):
+    """Ranks (1-based) of retrieved results matching an expected page, and the
+    share of expected pages found."""
+    expected = example["expected"]
+    ranks, found = [], set()
+    for rank, doc in enumerate(docs, start=1):
+        for i, target in enumerate(expected):
+            if doc.metadata.get("name") == target["name"] and (
+                    "page" not in target or doc.metadata.get("page") == target["page"]):
+                ranks.append(rank)
+                found.add(i)
+    return ranks, len(found) / len(expected)
+
+
+def evaluate(retriever, labeled, top_k, rerank, packer):
+    recalls, reciprocal_ranks, latencies, retrieved_tokens, packed_tokens = [], [], [], [], []
+    for example in labeled:
+        started_at = time.perf_counter()
+        docs = retriever.invoke(example["question"], config={
+            "configurable": {"search_kwargs": search_kwargs(example, top_k, rerank)}
+        })[:top_k]
+        latencies.append((time.perf_counter() - started_at) * 1000)
+
+        ranks, recall = relevance(example, docs)
+        recalls.append(recall)
+        reciprocal_ranks.append(1 / ranks[0] if ranks else 0)
+        retrieved_tokens.append(sum(count_tokens(doc.page_content) for doc in docs))
+        packed_tokens.append(packer.pack(docs, example["question"])["kept_tokens"])
+
+    latencies.sort()
+    return {
+        "recall": statistics.mean(recalls),
+        "mrr": statistics.mean(reciprocal_ranks),
+        "latency_p50_ms": latencies[len(latencies) // 2],
+        "latency_p95_ms": latencies[min(len(latencies) - 1, round(0.95 * (len(latencies) - 1)))],
+        "retrieved_tokens": statistics.mean(retrieved_tokens),
+        "packed_tokens": statistics.mean(packed_tokens),
+    }
+
+
+def print_results(results):
+    print(f"{'chunk':>6} {'hybrid':>6} {'rerank':>6} {'k':>4} {'recall@k':>9} {'MRR':>6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'retrieved':>10} {'packed':>8}")
+    for row in results:
+        print(f"{row['chunk_tokens'] or 'page':>6} {'on' if row['hybrid'] else 'off':>6} "
+              f"{'on' if row['rerank'] else 'off':>6} {row['top_k']:>4} "
+              f"{row['recall']:>9.3f} {row['mrr']:>6.3f} {row['latency_p50_ms']:>8.1f} "
+              f"{row['latency_p95_ms']:>8.1f} {row['retrieved_tokens']:>10.0f} "
+              f"{row['packed_tokens']:>8.0f}")
+
+
+def main():
+    args = parse_args()
+    labeled = load_labeled(args.labeled)
+    for example in labeled:
+        if example.get("tag"):
+            example["namespace"] = PineconeManager.tag_namespace(example["tag"], args.user)
+    packer = R.get_context_packer(args.model)
+
+    # embed every question once, so latencies compare retrieval, not the API
+    embeddings = R.get_query_embeddings()
+    for example in labeled:
+        embeddings.embed_query(example["question"])
+
+    chunked = [size for size in args.chunk_tokens if size > 0]
+    if chunked and not args.corpus:
+        sys.exit("--chunk-tokens needs --corpus to build the chunked index")
+    corpus = load_corpus(args.corpus, args.tag) if chunked else []
+
+    results = []
+    for chunk_tokens in args.chunk_tokens:
+        # the lexical index only holds whole pages
+        index = build_chunk_index(corpus, chunk_tokens, args.user) if chunk_tokens else None
+        for hybrid, rerank in itertools.product(args.hybrid, args.rerank):
+            if chunk_tokens and SWITCHES[hybrid]:
+                continue
+            for top_k in args.top_k:
+                retriever = R.get_retriever(
+                    st.secrets["INDEX_NAME"],
+                    index=index,
+                    hybrid=SWITCHES[hybrid],
+                    rerank=SWITCHES[rerank],
+                    top_n=top_k
+                )
+                results.append({
+                    "chunk_tokens": chunk_tokens,
+                    "hybrid": SWITCHES[hybrid],
+                    "rerank": SWITCHES[rerank],
+                    "top_k": top_k,
+                    **evaluate(retriever, labeled, top_k, SWITCHES[rerank], packer),
+                })
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
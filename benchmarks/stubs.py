@@ -0,0 +1,95 @@
+"""Local stand-ins for the providers used by the RAG chain."""
+import time
+import asyncio
+import hashlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from managers.text_utils import count_tokens
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic unit vectors seeded by the text hash, with an optional delay."""
+
+    def __init__(self, *args, dimension=256, latency=0.0, **kwargs):
+        self.dimension = dimension
+        self.latency = latency
+
+    def _embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimension)
+        return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return self._embed(text)
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.latency)
+        return self._embed(text)
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Streams `answer_tokens` tokens after `ttft` seconds at `tokens_per_second`,
+    reporting usage like the real providers do."""
+
+    model_name: str = "scripted"
+    ttft: float = 0.2
+    tokens_per_second: float = 80.0
+    answer_tokens: int = 100
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def _usage(self, messages):
+        input_tokens = sum(count_tokens(str(message.content)) for message in messages)
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": self.answer_tokens,
+            "total_tokens": input_tokens + self.answer_tokens,
+        }
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.ttft + self.answer_tokens / self.tokens_per_second)
+        message = AIMessage(
+            content="答" * self.answer_tokens, usage_metadata=self._usage(messages))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.ttft)
+        for i in range(self.answer_tokens):
+            if i:
+                time.sleep(1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content="答"))
+            if run_manager:
+                run_manager.on_llm_new_token("答", chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="", usage_metadata=self._usage(messages)))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.ttft)
+        for i in range(self.answer_tokens):
+            if i:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content="答"))
+            if run_manager:
+                await run_manager.on_llm_new_token("答", chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="", usage_metadata=self._usage(messages)))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.ttft + self.answer_tokens / self.tokens_per_second)
+        message = AIMessage(
+            content="答" * self.answer_tokens, usage_metadata=self._usage(messages))
+        return ChatResult(generations=[ChatGeneration(message=message)])
@@ -3,12 +3,11 @@ import uuid
 import requests
 import pandas as pd
 import streamlit as st
-from langchain_conversational_rag import rag
+from langchain_conversational_rag import arag, iterate_async, run_async
 from openai import OpenAI
 from datetime import datetime
-from langchain_community.callbacks import get_openai_callback
 
-from managers import DocumentManager, SessionManager, CostManager
+from managers import DocumentManager, SessionManager, CostManager, PineconeManager, UsageMeter
 
 client = OpenAI(api_key=st.secrets['OPENAI_API_KEY'])
 # reload messages from google sheet
@@ -209,41 +208,31 @@ def calculate_cost(prompt_tokens, completion_tokens):
 # Accept user input
 if prompt := st.chat_input("輸入你的問題", key="user_query",
                            on_submit=add_chat_history, disabled=disable_chat_input):
-    # if no documents are selected, pass all documents with tag "select_tag" to rag
-    if select_documents is None or len(select_documents) == 0:
-        document_names = document_options
-    else:
-        document_names = select_documents
-
-    _, stream = rag(
-        prompt,
-        model_id=select_model,
-        document_names=document_names,
-        session_id=st.session_state.selected_dialog,
-        temperature=temp
-    )
-
-    # Display assistant response in chat message container
-    with st.chat_message("assistant"):
-        def generate_response():
-            with get_openai_callback() as cb:
-                for chunk in stream:
+    # usage of the rewrite, query embedding and answer stages of this turn;
+    # the owner is also billed for background work the turn schedules
+    with UsageMeter.track(owner=(st.session_state.username, st.session_state.token)) as meter:
+        # if no documents are selected, rag searches the whole namespace of
+        # "select_tag", which only holds the user's documents
+        # the chain runs on the shared event loop instead of blocking this thread
+        _, stream = run_async(arag(
+            prompt,
+            model_id=select_model,
+            document_names=select_documents or None,
+            session_id=st.session_state.selected_dialog,
+            temperature=temp,
+            namespace=PineconeManager.tag_namespace(select_tag)
+        ))
+
+        # Display assistant response in chat message container
+        with st.chat_message("assistant"):
+            def generate_response():
+                for chunk in iterate_async(stream):
                     if answer_chunk := chunk.get("answer"):
                         yield (answer_chunk)
 
-                if "gpt" in select_model:
-                    total_cost = cb.total_cost
-                else:
-                    # calculate pricing for anthropic model
-                    total_cost = CostManager.calculate_cost(
-                        cb.prompt_tokens,
-                        cb.completion_tokens,
-                        select_model
-                    )
-
-                CostManager.update_cost(total_cost)
+            response = st.write_stream(generate_response)
 
-        response = st.write_stream(generate_response)
+    CostManager.update_cost(meter.total_cost)
 
     chat_id = update_chat_history(response, 'assistant')
     title = st.session_state.selected_dialog
@@ -3,20 +3,49 @@ from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.prompts import MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import (
+    ConfigurableField,
+    ConfigurableFieldSpec,
+    RunnableLambda,
+    RunnableParallel,
+    RunnablePassthrough
+)
+from langchain_core.runnables.config import run_in_executor
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_community.chat_message_histories import SQLChatMessageHistory
-from langchain.chains import create_history_aware_retriever
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain_anthropic import ChatAnthropic
+from langchain_openai import OpenAIEmbeddings
 from langchain_pinecone import PineconeVectorStore
-from langchain import hub
-from pinecone import Pinecone, ServerlessSpec
 import streamlit as st
+import time
 import uuid
+import queue
+import asyncio
+import threading
+import contextvars
+
+from managers.text_utils import count_tokens
+from managers.tracer import current_span_var
+from managers import (
+    AnswerCache,
+    CachedEmbeddings,
+    ContextPacker,
+    EmbeddingCache,
+    HistoryManager,
+    LexicalIndex,
+    LRUCache,
+    ModelRegistry,
+    PineconeManager,
+    PromptManager,
+    QuestionRewriter,
+    Reranker,
+    SpeculativeRetriever,
+    Tracer,
+    TracingCallbackHandler,
+    get_vector_index,
+    reciprocal_rank_fusion
+)
 
 # Import required dependencies 
 from typing import Any, Dict, List, Optional, Union, Protocol
@@ -61,145 +90,683 @@ contextualize_q_system_prompt = (
 
 
 def get_index(index_name):
-    pc = Pinecone(api_key=st.secrets['PINECONE_API_KEY'])
-    index = pc.Index(index_name)
-    return index
+    return get_vector_index(index_name)
 
 
-def get_retriever(index_name, document_names):
+@st.cache_resource
+def get_query_embeddings():
     model_name = 'text-embedding-3-small'
-    embeddings = OpenAIEmbeddings(model=model_name)
+    # repeated questions are answered from the shared cache instead of the API
+    return CachedEmbeddings(
+        OpenAIEmbeddings(model=model_name),
+        EmbeddingCache.get_shared(),
+        model_name
+    )
+
+
+def get_retriever(index_name, index=None, hybrid=None, rerank=None, top_n=None):
+    """Vector retriever, fused with lexical hits and reranked as configured.
 
-    index = get_index(index_name)
+    `index`, `hybrid`, `rerank` and `top_n` override the configured index and
+    retrieval stages, e.g. to compare candidate configurations.
+    """
+    embeddings = get_query_embeddings()
+
+    if index is None:
+        index = get_index(index_name)
     text_field = "content"
     vectorstore = PineconeVectorStore(
         index, embeddings, text_field
     )
 
-    search_kwargs = {
-        "k": st.secrets.rag.top_k,
-        "filter": {
-            "name": {
-                "$in": document_names
-            }
-        }
-    }
+    # the document filter changes every turn, so it is bound at call time
+    # through the "search_kwargs" configurable instead of being baked into
+    # the cached chain
+    retriever = vectorstore.as_retriever(
+        search_kwargs=get_search_kwargs(None)
+    ).configurable_fields(
+        search_kwargs=ConfigurableField(
+            id="search_kwargs",
+            name="Search kwargs",
+            description="Per-turn retrieval arguments (top k and document filter)",
+        )
+    )
 
-    retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
+    if LexicalIndex.is_enabled() if hybrid is None else hybrid:
+        retriever = RunnableParallel(
+            query=RunnablePassthrough(), docs=retriever
+        ) | RunnableLambda(fuse_lexical_results, name="hybrid_search")
+
+    reranker = get_reranker(rerank, top_n)
+    if reranker is not None:
+        retriever = RunnableParallel(
+            query=RunnablePassthrough(), docs=retriever
+        ) | RunnableLambda(
+            lambda x: reranker.rerank(x["query"], x["docs"]), name="rerank"
+        )
     return retriever
 
 
-# Formatting search results
-def format_docs(docs):
-    result = []
-    for doc in docs:
-        name = doc.metadata['name']
-        page = doc.metadata['page']
-        content = doc.page_content
-        # result.append(f'<item name="{name}" page="{page}">\n<page_content>\n{content}\n</page_content>\n</item>')
-        # Shortened format, keeping only essential information
-        result.append(f'<item name="{name}" page="{page}">{content}</item>')
+def fuse_lexical_results(x, config):
+    """Fuse vector hits with BM25 hits from the local lexical index (RRF)."""
+    search_kwargs = config.get("configurable", {}).get(
+        "search_kwargs", get_search_kwargs(None))
+    lexical_filter = dict(search_kwargs.get("filter") or {})
+    if search_kwargs.get("namespace"):
+        lexical_filter["namespace"] = search_kwargs["namespace"]
 
-    return '\n'.join(result)
+    lexical_docs = LexicalIndex.get_shared().search(
+        x["query"],
+        k=search_kwargs["k"],
+        filter=lexical_filter
+    )
+    return reciprocal_rank_fusion([x["docs"], lexical_docs])[:search_kwargs["k"]]
 
 
-def get_rag_chain(
-    model_id,
-    document_names,
-    temperature=0,
-    index_name='demand-foresight'
-):
-    retriever = get_retriever(index_name, document_names)
-    if 'gpt' in model_id:
-        llm = ChatOpenAI(
-            model=model_id,
-            temperature=temperature,
-            max_tokens=16384,
-            model_kwargs={"stream_options": {"include_usage": True}},
-            api_key=st.secrets['OPENAI_API_KEY'],
-        )
-    elif 'claude' in model_id:
-        llm = ChatAnthropic(
-            model=model_id,
-            temperature=temperature,
-            max_tokens=8192,
-            stream_usage=True,
-            api_key=st.secrets['ANTHROPIC_API_KEY']
-        )
+def get_reranker(enabled=None, top_n=None):
+    rerank_config = st.secrets.rag.get("rerank", {})
+    if not (rerank_config.get("enabled", False) if enabled is None else enabled):
+        return None
 
-    contextualize_q_prompt = hub.pull(
-        st.secrets.prompts.rag_contextualize_q_system_prompt,
-        api_key=st.secrets.LANGCHAIN_API_KEY
+    return Reranker(
+        top_n=top_n or rerank_config.get("top_n", 10),
+        lexical_weight=rerank_config.get("lexical_weight", 0.5),
+        cross_encoder=rerank_config.get("cross_encoder"),
+        batch_size=rerank_config.get("batch_size", 16),
+        latency_budget_ms=rerank_config.get("latency_budget_ms", 300)
     )
 
-    history_aware_retriever = create_history_aware_retriever(
-        llm, retriever, contextualize_q_prompt
+
+def get_search_kwargs(document_names, namespace=None):
+    """Per-turn retrieval arguments.
+
+    Vectors are partitioned into one namespace per user and tag (see
+    `PineconeManager.tag_namespace`), so `document_names=None` searches the
+    whole tag without a filter.
+    """
+    rerank_config = st.secrets.rag.get("rerank", {})
+    if rerank_config.get("enabled", False):
+        # over-fetch candidates for the reranker to choose from
+        k = rerank_config.get("fetch_k", 50)
+    else:
+        k = st.secrets.rag.top_k
+
+    search_kwargs = {"k": k, "namespace": namespace}
+    if document_names is not None:
+        search_kwargs["filter"] = {
+            "name": {
+                "$in": document_names
+            }
+        }
+    return search_kwargs
+
+
+def get_context_packer(model_id):
+    """Context packer using the model's token budget for retrieved pages."""
+    budgets = st.secrets.rag.get("context_token_budgets", {})
+    token_budget = budgets.get(
+        model_id, st.secrets.rag.get("context_token_budget", 12000))
+    return ContextPacker(
+        token_budget,
+        max_page_tokens=st.secrets.rag.get("max_page_tokens"),
+        dedupe_threshold=st.secrets.rag.get("dedupe_threshold", 0.9),
+        # a stable page order keeps the cached prompt prefix reusable
+        order="document" if uses_prompt_cache(model_id) else "score"
     )
 
-    prompt = hub.pull(
-        st.secrets.prompts.rag_system_prompt,
-        api_key=st.secrets.LANGCHAIN_API_KEY
+
+def uses_prompt_cache(model_id):
+    """Whether the answer prompt gets Anthropic `cache_control` breakpoints.
+
+    A fallback model of another provider gets the messages without them
+    (see `ModelRegistry.get_input_format`).
+    """
+    if not st.secrets.rag.get("prompt_caching", True):
+        return False
+    return ModelRegistry.get_spec(model_id)["provider"] == "anthropic"
+
+
+def mark_prompt_cache(x):
+    """Put cache breakpoints after the system prompt and after the documents block.
+
+    The system prompt is the same for every turn, and follow-up turns that
+    retrieve the same pages reuse the documents block as well.
+    """
+    messages = x["prompt_value"].to_messages()
+    context = x["context"]
+    cached = []
+    for message in messages:
+        content = message.content
+        if not context or not isinstance(content, str) or context not in content:
+            if message.type == "system" and isinstance(content, str):
+                message = message.model_copy(update={"content": [
+                    {"type": "text", "text": content, "cache_control": {"type": "ephemeral"}},
+                ]})
+            cached.append(message)
+            continue
+
+        before, after = content.split(context, 1)
+        blocks = [
+            {"type": "text", "text": before, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": context, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": after},
+        ]
+        # empty blocks are rejected by the API
+        blocks = [block for block in blocks if block["text"].strip()]
+        cached.append(message.model_copy(update={"content": blocks}))
+        context = None
+    return cached
+
+
+def build_rag_chain(
+    model_id,
+    temperature=0,
+    index_name='demand-foresight'
+):
+    retriever = get_retriever(index_name)
+    llm = ModelRegistry.get_answer_model(model_id, temperature)
+
+    prompt_manager = get_prompt_manager()
+    contextualize_q_prompt = prompt_manager.get(
+        st.secrets.prompts.rag_contextualize_q_system_prompt
     )
 
+    rewriter = get_question_rewriter(
+        contextualize_q_prompt,
+        prompt_manager.version(st.secrets.prompts.rag_contextualize_q_system_prompt)
+    ).as_runnable().with_config(tags=["stage:rewrite"])
+    if st.secrets.rag.get("speculative_retrieval", False):
+        # retrieve for the raw question while the rewrite is running
+        history_aware_retriever = SpeculativeRetriever(
+            retriever,
+            rewriter,
+            get_query_embeddings(),
+            threshold=st.secrets.rag.get("speculative_threshold", 0.9),
+            stats=get_retrieval_stats()
+        ).as_runnable()
+    else:
+        history_aware_retriever = rewriter | retriever
+
+    prompt = prompt_manager.get(st.secrets.prompts.rag_system_prompt)
+
+    context_packer = get_context_packer(model_id)
+    if uses_prompt_cache(model_id):
+        prompt = RunnablePassthrough.assign(prompt_value=prompt) | RunnableLambda(
+            mark_prompt_cache, name="prompt_cache")
     chain = (
         RunnablePassthrough.assign(
-            context=(lambda x: format_docs(x["context"])))
+            context=(lambda x: x["packed_context"]["text"]))
         | prompt
         | llm
         | StrOutputParser()
-    )
+    ).with_config(tags=["stage:answer"])
 
+    # "packed_context" carries the prompt text plus kept/dropped token counts
     rag_chain = RunnablePassthrough.assign(context=history_aware_retriever).assign(
+        packed_context=RunnableLambda(
+            lambda x: context_packer.pack(x["context"], x["input"]), name="context_pack")
+    ).assign(
         answer=chain
     )
-    return rag_chain
+    return RunnableWithMessageHistory(
+        rag_chain,
+        get_session_history,
+        input_messages_key="input",
+        history_messages_key="chat_history",
+        output_messages_key="answer",
+        history_factory_config=[
+            ConfigurableFieldSpec(
+                id="session_id",
+                annotation=str,
+                name="Session ID",
+                description="Unique identifier for a session.",
+                default="",
+                is_shared=True,
+            ),
+            ConfigurableFieldSpec(
+                id="history",
+                annotation=Optional[BaseChatMessageHistory],
+                name="History",
+                description="History of the session the turn has already loaded, or None.",
+                default=None,
+                is_shared=True,
+            ),
+        ],
+    )
 
 
-def get_session_history(session_id):
-    return SQLChatMessageHistory(session_id, "sqlite:///memory.db")
+def get_question_rewriter(contextualize_q_prompt, prompt_version):
+    """Rewriter for follow-up questions, on a small model separate from the answer model."""
+    rag_config = st.secrets.rag
+    model_id = rag_config.get("rewriter_model", "gpt-4o-mini")
+    llm = ModelRegistry.get_chat_model(
+        model_id, 0, max_tokens=rag_config.get("rewriter_max_tokens", 256))
 
+    return QuestionRewriter(
+        llm,
+        contextualize_q_prompt,
+        max_turns=rag_config.get("rewriter_history_turns", 2),
+        cache=get_rewrite_cache(),
+        version=f"{model_id}:{prompt_version}"
+    )
 
-def rag(
-    question,
+
+@st.cache_resource
+def get_rewrite_cache():
+    """Standalone rewrites of follow-up questions, shared by every session."""
+    return LRUCache(
+        max_entries=st.secrets.rag.get("rewriter_cache_size", 1024),
+        ttl=st.secrets.rag.get("rewriter_cache_ttl", 3600)
+    )
+
+
+@st.cache_resource
+def get_retrieval_stats():
+    """Latency of the retrieval paths of the most recent turn of each session."""
+    return LRUCache(max_entries=1024)
+
+
+@st.cache_resource
+def get_prompt_manager():
+    """Process-wide prompt store backed by a local snapshot of the hub prompts.
+
+    The bundled prompts above are served until the first successful pull.
+    """
+    fallbacks = {
+        st.secrets.prompts.rag_contextualize_q_system_prompt: ChatPromptTemplate.from_messages([
+            ("system", contextualize_q_system_prompt),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+        ]),
+        st.secrets.prompts.rag_system_prompt: ChatPromptTemplate.from_messages([
+            ("system", system_prompt),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+        ]),
+    }
+    prompt_manager = PromptManager(
+        fallbacks,
+        api_key=st.secrets.LANGCHAIN_API_KEY,
+        snapshot_path=st.secrets.prompts.get("snapshot_path", ".cache/prompts.json"),
+        refresh_interval=st.secrets.prompts.get("refresh_interval", 600)
+    )
+    return prompt_manager.start()
+
+
+@st.cache_resource
+def get_chain_registry():
+    """Process-wide registry of compiled RAG chains shared by all sessions."""
+    return LRUCache(
+        max_entries=st.secrets.rag.get("chain_cache_size", 16),
+        ttl=st.secrets.rag.get("chain_cache_ttl", 3600)
+    )
+
+
+def get_rag_chain(
     model_id,
-    document_names,
-    session_id=None,
-    temperature=0
+    temperature=0,
+    index_name='demand-foresight'
 ):
-    rag_chain = get_rag_chain(
+    """Return the compiled conversational RAG chain, building it on first use.
+
+    Chains hold no per-turn state: the document filter is supplied through the
+    "search_kwargs" configurable and the session through "session_id".
+    """
+    prompt_manager = get_prompt_manager()
+    key = (
         model_id,
-        document_names,
-        temperature=temperature,
-        index_name=st.secrets['INDEX_NAME']
+        temperature,
+        index_name,
+        prompt_manager.version(st.secrets.prompts.rag_contextualize_q_system_prompt),
+        prompt_manager.version(st.secrets.prompts.rag_system_prompt),
     )
-    conversational_rag_chain = RunnableWithMessageHistory(
-        rag_chain,
-        get_session_history,
-        input_messages_key="input",
-        history_messages_key="chat_history",
-        output_messages_key="answer",
+    return get_chain_registry().get_or_create(
+        key,
+        lambda: build_rag_chain(
+            model_id, temperature=temperature, index_name=index_name)
     )
 
-    if session_id is None:
-        session_id = str(uuid.uuid4())
+
+def get_session_history(session_id, history=None):
+    """History of the session; `history` is one the turn has already loaded."""
+    if history is not None:
+        return history
+    return HistoryManager.get_session_history(session_id)
+
+
+def preload_history(session_id):
+    history = get_session_history(session_id)
+    history.preload()
+    return history
+
+
+def rag(
+    question,
+    model_id,
+    document_names=None,
+    session_id=None,
+    temperature=0,
+    namespace=None
+):
+    tracer = Tracer.get_shared()
+    turn = tracer.start(
+        "rag", model=model_id, namespace=namespace, documents=len(document_names or []))
+
+    with tracer.span("rag.setup", parent=turn):
+        conversational_rag_chain = get_rag_chain(
+            model_id,
+            temperature=temperature,
+            index_name=st.secrets['INDEX_NAME']
+        )
+
+        if session_id is None:
+            session_id = str(uuid.uuid4())
+
+        answer_cache = AnswerCache.get_shared()
+        history = get_session_history(session_id)
+        # only standalone questions are cached: follow-ups depend on the dialog;
+        # the chain reuses the preloaded window instead of reading it again
+        use_answer_cache = answer_cache.enabled and len(history.preload()) == 0
+        if use_answer_cache:
+            query_embedding = get_query_embeddings().embed_query(question)
+            bucket = AnswerCache.make_bucket(
+                namespace,
+                document_names or [],
+                model_id,
+                temperature,
+                get_prompt_manager().version(st.secrets.prompts.rag_system_prompt)
+            )
+            chunks = answer_cache.lookup(bucket, query_embedding)
+            if chunks is not None:
+                turn.set(answer_cache_hit=True)
+                return session_id, trace_answer(
+                    replay_answer(question, chunks, history), tracer, turn)
 
     stream = conversational_rag_chain.stream(
         {"input": question},
-        config={"configurable": {"session_id": session_id}},
+        config={
+            "configurable": {
+                "session_id": session_id,
+                "history": history,
+                "search_kwargs": get_search_kwargs(document_names, namespace),
+            },
+            "callbacks": get_tracing_callbacks(tracer, turn),
+        },
     )
 
-    return session_id, stream
+    if use_answer_cache:
+        stream = record_answer(
+            stream,
+            lambda chunks: answer_cache.store(
+                bucket,
+                EmbeddingCache.text_key(question),
+                query_embedding,
+                chunks
+            )
+        )
+
+    # summarize old turns once the answer is saved, off the answer path
+    stream = record_answer(
+        stream, lambda chunks: HistoryManager.schedule_compaction(session_id))
+
+    return session_id, trace_answer(stream, tracer, turn)
+
+
+def get_tracing_callbacks(tracer, turn):
+    """Callbacks turning the chain's retriever, model and named steps into spans."""
+    return [TracingCallbackHandler(tracer, turn)] if tracer.enabled else []
+
+
+def trace_answer(stream, tracer, turn):
+    """Pass the stream through as the "rag" span, recording TTFT and answer size."""
+    iterator = iter(stream)
+    answer_tokens = 0
+    while True:
+        # spans opened while producing a chunk are children of this turn
+        token = current_span_var.set(turn)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            break
+        except Exception as e:
+            tracer.finish(turn, error=type(e).__name__)
+            raise
+        finally:
+            current_span_var.reset(token)
+
+        if answer_chunk := chunk.get("answer"):
+            if "ttft_ms" not in turn.attributes:
+                turn.set(ttft_ms=(time.perf_counter() - turn.started_at) * 1000)
+            answer_tokens += count_tokens(answer_chunk)
+        yield chunk
+
+    tracer.finish(turn, answer_tokens=answer_tokens)
+
+
+async def atrace_answer(stream, tracer, turn):
+    iterator = aiter(stream)
+    answer_tokens = 0
+    while True:
+        token = current_span_var.set(turn)
+        try:
+            chunk = await anext(iterator)
+        except StopAsyncIteration:
+            break
+        except Exception as e:
+            tracer.finish(turn, error=type(e).__name__)
+            raise
+        finally:
+            current_span_var.reset(token)
+
+        if answer_chunk := chunk.get("answer"):
+            if "ttft_ms" not in turn.attributes:
+                turn.set(ttft_ms=(time.perf_counter() - turn.started_at) * 1000)
+            answer_tokens += count_tokens(answer_chunk)
+        yield chunk
+
+    tracer.finish(turn, answer_tokens=answer_tokens)
+
+
+def replay_answer(question, chunks, history):
+    """Stream a cached answer in the same chunk format as the RAG chain."""
+    yield {"input": question}
+    for chunk in chunks:
+        yield {"answer": chunk}
+
+    # keep the dialog history consistent with a generated answer
+    history.add_messages([
+        HumanMessage(content=question),
+        AIMessage(content="".join(chunks)),
+    ])
+
+
+def record_answer(stream, on_complete):
+    """Pass the chain stream through and hand the answer chunks to `on_complete`."""
+    chunks = []
+    for chunk in stream:
+        if answer_chunk := chunk.get("answer"):
+            chunks.append(answer_chunk)
+        yield chunk
+
+    if chunks:
+        on_complete(chunks)
+
+
+async def arag(
+    question,
+    model_id,
+    document_names=None,
+    session_id=None,
+    temperature=0,
+    namespace=None
+):
+    """Async counterpart of `rag()`, returning an async stream of chain chunks.
+
+    The chain, the dialog history and the answer cache lookup touch Pinecone,
+    the prompt store, SQL and SQLite synchronously, so they run in the
+    default executor rather than stalling the loop shared by every session.
+    The history is loaded once, concurrently with building the chain and
+    embedding the question, and handed to the chain. The question is
+    embedded up front only where that embedding is used: by the answer
+    cache, or by speculative retrieval, which retrieves for the raw question.
+    """
+    tracer = Tracer.get_shared()
+    turn = tracer.start(
+        "rag", model=model_id, namespace=namespace, documents=len(document_names or []))
+
+    with tracer.span("rag.setup", parent=turn):
+        if session_id is None:
+            session_id = str(uuid.uuid4())
+
+        answer_cache = AnswerCache.get_shared()
+        loads = [
+            run_in_executor(
+                None,
+                get_rag_chain,
+                model_id,
+                temperature=temperature,
+                index_name=st.secrets['INDEX_NAME']
+            ),
+            run_in_executor(None, preload_history, session_id),
+        ]
+        if answer_cache.enabled or st.secrets.rag.get("speculative_retrieval", False):
+            loads.append(get_query_embeddings().aembed_query(question))
+        conversational_rag_chain, history, *query_embedding = await asyncio.gather(*loads)
+
+        # only standalone questions are cached: follow-ups depend on the dialog
+        use_answer_cache = answer_cache.enabled and len(history.messages) == 0
+        if use_answer_cache:
+            bucket = AnswerCache.make_bucket(
+                namespace,
+                document_names or [],
+                model_id,
+                temperature,
+                get_prompt_manager().version(st.secrets.prompts.rag_system_prompt)
+            )
+            query_embedding = query_embedding[0]
+            chunks = await run_in_executor(
+                None, answer_cache.lookup, bucket, query_embedding)
+            if chunks is not None:
+                turn.set(answer_cache_hit=True)
+                return session_id, atrace_answer(
+                    areplay_answer(question, chunks, history), tracer, turn)
+
+    stream = conversational_rag_chain.astream(
+        {"input": question},
+        config={
+            "configurable": {
+                "session_id": session_id,
+                "history": history,
+                "search_kwargs": get_search_kwargs(document_names, namespace),
+            },
+            "callbacks": get_tracing_callbacks(tracer, turn),
+        },
+    )
+
+    if use_answer_cache:
+        stream = arecord_answer(
+            stream,
+            lambda chunks: answer_cache.store(
+                bucket,
+                EmbeddingCache.text_key(question),
+                query_embedding,
+                chunks
+            )
+        )
+
+    stream = arecord_answer(
+        stream, lambda chunks: HistoryManager.schedule_compaction(session_id))
+
+    return session_id, atrace_answer(stream, tracer, turn)
+
+
+async def areplay_answer(question, chunks, history):
+    yield {"input": question}
+    for chunk in chunks:
+        yield {"answer": chunk}
+
+    await history.aadd_messages([
+        HumanMessage(content=question),
+        AIMessage(content="".join(chunks)),
+    ])
+
+
+async def arecord_answer(stream, on_complete):
+    chunks = []
+    async for chunk in stream:
+        if answer_chunk := chunk.get("answer"):
+            chunks.append(answer_chunk)
+        yield chunk
+
+    if chunks:
+        on_complete(chunks)
+
+
+@st.cache_resource
+def get_event_loop():
+    """Event loop shared by every session, running on its own daemon thread.
+
+    Script threads only wait on queues while the loop multiplexes the
+    model and embedding requests of all concurrent chats.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="rag-event-loop", daemon=True).start()
+    return loop
+
+
+def run_async(coroutine):
+    """Run a coroutine on the shared loop and wait for its result."""
+    context = contextvars.copy_context()
+    future = asyncio.run_coroutine_threadsafe(
+        _with_context(coroutine, context), get_event_loop())
+    return future.result()
+
+
+async def _with_context(coroutine, context):
+    # run in the caller's context so callback handlers such as
+    # get_openai_callback() still see the chain's runs
+    return await asyncio.get_running_loop().create_task(coroutine, context=context)
+
+
+def iterate_async(stream):
+    """Drain an async stream on the shared loop, yielding its items here.
+
+    This is the sync adapter for `st.write_stream`.
+    """
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in stream:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        finally:
+            items.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(
+        _with_context(pump(), contextvars.copy_context()), get_event_loop())
+    try:
+        while (item := items.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # a consumer that stops early (e.g. a rerun of the page) also stops
+        # the chain, instead of letting it stream tokens nobody reads
+        future.cancel()
 
 
 if __name__ == '__main__':
     model_id = "claude-3-opus-20240229"
-    tag = 'AI'
+    namespace = PineconeManager.tag_namespace('AI', username=st.secrets.ADMIN_NAME)
     question = '哪一個機關負責老人狀況調查'
     temperature = 0
     session_id, stream = rag(
         question,
         model_id,
-        tag=tag,
+        namespace=namespace,
         temperature=temperature
     )
 
@@ -212,7 +779,7 @@ if __name__ == '__main__':
     _, stream = rag(
         question,
         model_id,
-        tag=tag,
+        namespace=namespace,
         session_id=session_id,
         temperature=temperature
     )
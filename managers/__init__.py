@@ -1,6 +1,22 @@
 from .document_manager import DocumentManager
+from .ingestion import IngestionPipeline
 from .llm_manager import LLMManger
 from .pinecone_manager import PineconeManager
 from .session_manager import SessionManager
 from .tag_manager import TagManager
 from .cost_manager import CostManager
+from .model_registry import DeadlineFallback, ModelRegistry
+from .lru_cache import LRUCache
+from .prompt_manager import PromptManager
+from .embedding_manager import CachedEmbeddings, EmbeddingCache
+from .embedding_batcher import EmbeddingBatcher, RateLimiter
+from .answer_cache import AnswerCache
+from .context_packer import ContextPacker
+from .rerank_manager import Reranker
+from .lexical_index import LexicalIndex, reciprocal_rank_fusion
+from .vector_store import LocalVectorIndex, VectorIndex, get_vector_index
+from .history_manager import HistoryManager, WindowedChatMessageHistory
+from .speculative_retrieval import SpeculativeRetriever
+from .question_rewriter import QuestionRewriter
+from .usage_meter import UsageMeter
+from .tracer import Tracer, TracingCallbackHandler
@@ -0,0 +1,99 @@
+import numpy as np
+import streamlit as st
+
+from .lru_cache import LRUCache
+
+
+class AnswerCache:
+    """Opt-in semantic cache of streamed answers.
+
+    Entries are grouped by (namespace, sorted document names, model id,
+    temperature, prompt version) and matched on the cosine similarity of the query embedding, so
+    a question only replays an answer generated over exactly the same
+    documents. An empty document list stands for the whole namespace.
+    """
+
+    def __init__(self, enabled=False, threshold=0.95, max_entries=512, ttl=None):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.entries = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    @st.cache_resource
+    def get_shared():
+        """Return the answer cache shared by every session of this process."""
+        config = st.secrets.get("answer_cache", {})
+        return AnswerCache(
+            enabled=config.get("enabled", False),
+            threshold=config.get("threshold", 0.95),
+            max_entries=config.get("max_entries", 512),
+            ttl=config.get("ttl", 86400)
+        )
+
+    @staticmethod
+    def make_bucket(namespace, document_names, model_id, temperature, prompt_version):
+        # rounded like the model registry, so equal slider values share a bucket
+        return (
+            namespace,
+            tuple(sorted(set(document_names))),
+            model_id,
+            round(float(temperature), 2),
+            prompt_version,
+        )
+
+    def lookup(self, bucket, query_embedding):
+        """Return the cached answer chunks closest to the query, or None."""
+        query = AnswerCache._normalize(query_embedding)
+        best_key, best_score = None, self.threshold
+        for key in self.entries.keys():
+            if key[0] != bucket:
+                continue
+            entry = self.entries.peek(key)
+            if entry is None:
+                continue
+            score = float(np.dot(entry["embedding"], query))
+            if score >= best_score:
+                best_key, best_score = key, score
+
+        entry = self.entries.get(best_key) if best_key is not None else None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry["chunks"]
+
+    def store(self, bucket, query_key, query_embedding, chunks):
+        self.entries.put((bucket, query_key), {
+            "embedding": AnswerCache._normalize(query_embedding),
+            "chunks": list(chunks),
+        })
+
+    def invalidate_documents(self, document_names, namespaces):
+        """Drop every entry of `namespaces` whose document set contains one of
+        `document_names`.
+
+        Whole-namespace entries are dropped when any of their documents changes.
+        """
+        document_names, namespaces = set(document_names), set(namespaces)
+        for key in self.entries.keys():
+            namespace, names = key[0][0], key[0][1]
+            if namespace in namespaces and (not names or document_names.intersection(names)):
+                self.entries.pop(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries.keys()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
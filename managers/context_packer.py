@@ -0,0 +1,180 @@
+import re
+import functools
+
+import numpy as np
+
+from .text_utils import content_hash, count_tokens, lexical_terms
+
+# split pages after sentence-ending punctuation or line breaks
+PASSAGE_PATTERN = re.compile(r"(?<=[。！？；!?;\n])")
+
+# near-duplicate detection: 4-character shingles, one in eight sampled, and
+# 64 multiply-add hash functions for the MinHash signature
+SHINGLE_SIZE = 4
+SHINGLE_SAMPLE = np.uint64(8)
+SHINGLE_BASE = np.uint64(1000003)
+_random = np.random.default_rng(0)
+MINHASH_A = _random.integers(1, 2 ** 63, size=64, dtype=np.uint64) | np.uint64(1)
+MINHASH_B = _random.integers(0, 2 ** 63, size=64, dtype=np.uint64)
+
+
+class ContextPacker:
+    """Pack retrieved pages into the `{context}` block under a token budget.
+
+    Pages are ordered by retrieval score, identical or near-identical pages are
+    dropped, over-long pages are trimmed to the passages that best match the
+    question, and items are added until `token_budget` is spent. With
+    `order="document"` the kept items are emitted by (name, page), so the same
+    pages always produce the same block (and prompt-cache prefix).
+    """
+
+    def __init__(self, token_budget, max_page_tokens=None, dedupe_threshold=0.9, order="score"):
+        self.token_budget = token_budget
+        self.max_page_tokens = max_page_tokens or max(token_budget // 4, 1)
+        self.dedupe_threshold = dedupe_threshold
+        self.order = order
+
+    @staticmethod
+    def format_item(name, page, content):
+        return f'<item name="{name}" page="{page}">{content}</item>'
+
+    def pack(self, docs, question):
+        """Return the packed context text and how many tokens were kept/dropped."""
+        # a stable sort keeps the retriever's order for documents without a score
+        ranked = sorted(
+            docs, key=lambda doc: -doc.metadata.get("score", 0.0))
+        question_terms = set(lexical_terms(question))
+
+        items = []
+        seen = set()
+        kept_signatures = []
+        kept_tokens = 0
+        dropped_tokens = 0
+        duplicates = 0
+
+        for doc in ranked:
+            content = doc.page_content
+            content_tokens = count_tokens(content)
+
+            # exact repeats (same vector or same text) are caught before any sketching
+            keys = {doc.id, content_hash(content)} - {None}
+            if keys & seen:
+                duplicates += 1
+                dropped_tokens += content_tokens
+                continue
+
+            overhead = count_tokens(
+                ContextPacker.format_item(doc.metadata["name"], doc.metadata["page"], ""))
+            remaining = self.token_budget - kept_tokens - overhead
+            page_budget = min(self.max_page_tokens, remaining)
+            if page_budget <= 0:
+                dropped_tokens += content_tokens
+                continue
+
+            signature = ContextPacker._signature(content)
+            if signature is not None and ContextPacker._is_near_duplicate(
+                    signature, kept_signatures, self.dedupe_threshold):
+                duplicates += 1
+                dropped_tokens += content_tokens
+                continue
+
+            if content_tokens > page_budget:
+                content, trimmed_tokens = ContextPacker._trim(
+                    content, content_tokens, question_terms, page_budget)
+                if not content:
+                    dropped_tokens += content_tokens
+                    continue
+                dropped_tokens += content_tokens - trimmed_tokens
+                content_tokens = trimmed_tokens
+
+            seen |= keys
+            if signature is not None:
+                kept_signatures.append(signature)
+            kept_tokens += content_tokens + overhead
+            items.append((
+                (doc.metadata["name"], doc.metadata["page"]),
+                ContextPacker.format_item(doc.metadata["name"], doc.metadata["page"], content)
+            ))
+
+        if self.order == "document":
+            items.sort(key=lambda item: item[0])
+        items = [item for _, item in items]
+
+        return {
+            "text": "\n".join(items),
+            "documents": len(items),
+            "duplicates": duplicates,
+            "kept_tokens": kept_tokens,
+            "dropped_tokens": dropped_tokens,
+        }
+
+    @staticmethod
+    def _trim(content, content_tokens, question_terms, token_budget):
+        """Keep the passages sharing the most terms with the question, in page order.
+
+        Passages are charged their share of the page's `content_tokens` by
+        length instead of being tokenized again. Returns the trimmed text and
+        the tokens of the passages kept.
+        """
+        passages = [p for p in PASSAGE_PATTERN.split(content) if p.strip()]
+        # substring tests are much cheaper than tokenizing every passage
+        folded = [passage.casefold() for passage in passages]
+        scored = sorted(
+            range(len(passages)),
+            key=lambda i: -sum(term in folded[i] for term in question_terms)
+        )
+
+        tokens_per_char = content_tokens / max(len(content), 1)
+        selected = set()
+        used = 0
+        for i in scored:
+            tokens = max(round(len(passages[i]) * tokens_per_char), 1)
+            if used + tokens > token_budget:
+                continue
+            selected.add(i)
+            used += tokens
+
+        parts = []
+        for i in range(len(passages)):
+            if i in selected:
+                parts.append(passages[i])
+            elif parts and parts[-1] != "…":
+                parts.append("…")
+        # the "…" markers are not counted; they are a token each at most
+        return "".join(parts).strip("…"), used
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _signature(content):
+        """MinHash signature of the page's sampled 4-character shingles, or None
+        for pages too short to compare reliably; pages recur across turns, so memoize."""
+        codes = np.frombuffer(content.encode("utf-32-le", errors="ignore"), dtype=np.uint32)
+        # drop whitespace, so reflowed copies of a page compare equal
+        codes = codes[(codes > 32) & (codes != 0x3000) & (codes != 0xa0)].astype(np.uint64)
+        if len(codes) < SHINGLE_SIZE:
+            return None
+
+        # polynomial hash of every shingle, computed with wrapping uint64 arithmetic
+        count = len(codes) - SHINGLE_SIZE + 1
+        shingles = codes[:count].copy()
+        for i in range(1, SHINGLE_SIZE):
+            shingles = shingles * SHINGLE_BASE + codes[i: count + i]
+        # sample by hash value, so two pages keep the same subset of shared shingles
+        shingles = shingles[(shingles >> np.uint64(32)) % SHINGLE_SAMPLE == 0]
+        if len(shingles) < 8:
+            return None
+
+        hashed = MINHASH_A[:, None] * shingles[None, :] + MINHASH_B[:, None]
+        return hashed.min(axis=1), len(shingles)
+
+    @staticmethod
+    def _is_near_duplicate(signature, kept_signatures, threshold):
+        minhashes, size = signature
+        for other, other_size in kept_signatures:
+            # the size ratio bounds the similarity, so skip clearly different pages
+            if min(size, other_size) / max(size, other_size) < threshold:
+                continue
+            # the share of equal minimums estimates the Jaccard similarity
+            if np.count_nonzero(minhashes == other) >= threshold * len(minhashes):
+                return True
+        return False
@@ -1,27 +1,33 @@
 import streamlit as st
-import requests
 import pandas as pd
 from datetime import datetime
 
+from .model_registry import ModelRegistry
+from .tracer import http
+
 
 class CostManager:
     datetime_format = "%Y-%m-%d %H:%M:%S"
 
     @staticmethod
-    def update_cost(additional_cost):
+    def update_cost(additional_cost, username=None, token=None):
+        """Bill the cost to `username`, by default the user of this session.
+
+        Background work has no session, so it passes the owner it ran for.
+        """
         api_url = f"{st.secrets.BACKEND_URL}/cost"
         timestamp = datetime.now().strftime(CostManager.datetime_format)
         payload = {
-            "username": st.session_state.username,
+            "username": username or st.session_state.username,
             "cost": additional_cost,
             "timestamp": timestamp
         }
 
-        response = requests.post(
+        response = http.post(
             api_url, 
             json=payload,
             headers = {
-                "Authorization": f"Bearer {st.session_state.token}"
+                "Authorization": f"Bearer {token or st.session_state.token}"
             }
         )
         if response.status_code != 201:
@@ -31,32 +37,44 @@ class CostManager:
 
 
     @staticmethod
-    def calculate_cost(prompt_tokens, completion_tokens, model):
-        pricing = {
-            "claude-3-5-sonnet-20241022": {
-                "prompt_token": 3,
-                "completion_token": 15
-            },
-            "claude-3-7-sonnet-20250219": {
-                "prompt_token": 3,
-                "completion_token": 15
-            },
-            "text-embedding-3-small": {
-                "prompt_token": 0.02,
-                "completion_token": 0
-            },
-        }
-
-        if model not in pricing:
+    def calculate_cost(
+        prompt_tokens,
+        completion_tokens,
+        model,
+        cache_read_tokens=0,
+        cache_write_tokens=0
+    ):
+        """Cost in USD; `prompt_tokens` includes the cache read/write tokens."""
+        try:
+            pricing = ModelRegistry.get_spec(model)["pricing"]
+        except ValueError:
             st.error(
                 f"The selected model '{model}' is not supported for pricing calculations.")
             return 0
 
+        # cache reads are billed at 0.1x and writes at 1.25x the input price
+        cache_read_price = pricing.get("cache_read", 0.1 * pricing["input"])
+        cache_write_price = pricing.get("cache_write", 1.25 * pricing["input"])
+        uncached_tokens = prompt_tokens - cache_read_tokens - cache_write_tokens
         return (
-            pricing[model]["prompt_token"] * prompt_tokens
-            + pricing[model]["completion_token"] * completion_tokens
+            pricing["input"] * uncached_tokens
+            + cache_read_price * cache_read_tokens
+            + cache_write_price * cache_write_tokens
+            + pricing["output"] * completion_tokens
         ) / 1e6
 
+    @staticmethod
+    def calculate_usage_cost(usage_metadata, model):
+        """Cost of a LangChain `usage_metadata` record, including cached input."""
+        details = usage_metadata.get("input_token_details") or {}
+        return CostManager.calculate_cost(
+            usage_metadata.get("input_tokens", 0),
+            usage_metadata.get("output_tokens", 0),
+            model,
+            cache_read_tokens=details.get("cache_read") or 0,
+            cache_write_tokens=details.get("cache_creation") or 0
+        )
+
 
     @st.cache_data
     @staticmethod
@@ -70,7 +88,7 @@ class CostManager:
         cost_list = []
         with st.spinner("獲取使用者數據中..."):    
             params = {"username": username} if username is not None else None
-            response = requests.get(base_url, params=params, headers=headers)
+            response = http.get(base_url, params=params, headers=headers)
             if response.status_code == 200:
                 all_cost = response.json()["cost"]
                 cost_by_month = response.json()["cost_by_month"]
@@ -1,42 +1,38 @@
 import streamlit as st
-import io
-import PyPDF2
-import uuid
+import os
 import pandas as pd
-import requests
-import time
+import multiprocessing
 import concurrent.futures
 from pathlib import Path
 from stqdm import stqdm
 
+from .answer_cache import AnswerCache
 from .pinecone_manager import PineconeManager
 from .session_manager import SessionManager
-from .llm_manager import LLMManger
 from .cost_manager import CostManager
+from .ingestion import IngestionPipeline
+from .tracer import http
 
 
 class DocumentManager:
     @staticmethod
-    def load_pdf(bytes_data, tag, name, desc):
-        p = io.BytesIO(bytes_data)
-        reader = PyPDF2.PdfReader(p)
-        data = []
+    @st.cache_resource
+    def get_extraction_pool():
+        """Process pool for PDF text extraction, sized to the machine by default."""
+        workers = st.secrets.get("ingestion", {}).get("extraction_workers") or os.cpu_count()
+        # the Streamlit server is multi-threaded, so workers are spawned, not forked
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
 
-        for i in stqdm(range(len(reader.pages)), desc=desc):
-            content = reader.pages[i].extract_text()
-            clean_content = content.encode('utf-8', 'replace').decode('utf-8')
-
-            if len(content) < 10:
-                continue
-
-            data.append({
-                "tag": tag,
-                "name": name,
-                "page": i + 1,
-                "content": clean_content,
-            })
-
-        return data
+    @staticmethod
+    def renew_extraction_pool(broken):
+        """Replace the shared pool once a crashed worker has broken it."""
+        # another upload may have replaced it already
+        if DocumentManager.get_extraction_pool() is broken:
+            DocumentManager.get_extraction_pool.clear()
+        return DocumentManager.get_extraction_pool()
 
     @staticmethod
     def get_document_titles_by_tag(tag):
@@ -150,15 +146,20 @@ class DocumentManager:
                 selected_indices
             )
 
-            PineconeManager.delete_pinecone_documents(document_ids)
+            tags = my_documents.loc[selected_indices, "tag"].tolist()
+            PineconeManager.delete_pinecone_documents(document_ids, tags)
             SessionManager.delete_documents(document_ids)
+            AnswerCache.get_shared().invalidate_documents(
+                my_documents.loc[selected_indices, "title"].tolist(),
+                [PineconeManager.tag_namespace(tag) for tag in tags]
+            )
 
             headers = {
                 "Authorization": f"Bearer {st.session_state.token}"
             }
 
             for document_id in document_ids:
-                response = requests.delete(
+                response = http.delete(
                     f"{st.secrets.BACKEND_URL}/documents/{document_id}",
                     headers=headers
                 )
@@ -179,7 +180,7 @@ class DocumentManager:
                 }
                 
                 # update documents
-                response = requests.post(
+                response = http.post(
                     f"{st.secrets.BACKEND_URL}/documents",
                     json={
                         "title": documents[i]["title"],
@@ -197,7 +198,7 @@ class DocumentManager:
                     raise Exception(f"/documents responds status code {response.status_code}")
 
                 # update vectors
-                response = requests.post(
+                response = http.post(
                     f"{st.secrets.BACKEND_URL}/vectors",
                     json={
                         "document_id": document_id,
@@ -229,35 +230,57 @@ class DocumentManager:
         """Process each uploaded file by loading, embedding, and uploading to Google Sheets."""
         st.session_state.upload_failure = []
         documents = []
-        total_price = 0
-
-        for i, uploaded_file in enumerate(uploaded_files):
-            title = Path(uploaded_file.name).stem
-            try:
-                bytes_data = uploaded_file.getvalue()
-                data = DocumentManager.load_pdf(
-                    bytes_data, tag, title, desc=f"讀取第 {i+1} / {len(uploaded_files)} 份文件"
-                )
-                id_list, price = PineconeManager.upsert_documents(
-                    data, desc=f"計算第 {i+1} / {len(uploaded_files)} 份文件特徵向量"
-                )
 
-                total_price += price
-                content = "".join([page["content"] for page in data])
-                documents.append({
-                    "content": content,
-                    "title": title,
-                    "vectors": id_list,
-                    "tag": tag
-                })
+        config = st.secrets.get("ingestion", {})
+        pipeline = IngestionPipeline(
+            DocumentManager.get_extraction_pool(),
+            st.session_state.index,
+            tag,
+            PineconeManager.tag_namespace(tag),
+            extraction_workers=config.get("extraction_workers") or os.cpu_count(),
+            pages_per_task=config.get("pages_per_task", 8),
+            batch_size=config.get("batch_size", 64),
+            embedding_workers=config.get("embedding_workers", 2),
+            queue_size=config.get("queue_size", 8),
+            renew_pool=DocumentManager.renew_extraction_pool
+        )
+        titles = [Path(uploaded_file.name).stem for uploaded_file in uploaded_files]
+        files = [
+            (title, uploaded_file.getvalue())
+            for title, uploaded_file in zip(titles, uploaded_files)
+        ]
 
-            except Exception as e:
-                print(f"Failed to process {title}: {e}")
-                st.session_state.upload_failure.append(title)
+        # extraction, embedding and upserts of different files overlap, so a
+        # single bar tracks pages through the whole pipeline
+        with stqdm(total=0, desc=f"處理 {len(uploaded_files)} 份文件") as progress:
+            for event in pipeline.run(files):
+                if event[0] == "pages":
+                    progress.total += event[1]
+                    progress.refresh()
+                elif event[0] == "done":
+                    progress.update(event[1])
+                elif event[0] == "document":
+                    documents.append({**event[2], "tag": tag})
+                elif event[0] == "failed":
+                    print(f"Failed to process {titles[event[1]]}: {event[2]}")
+                    st.session_state.upload_failure.append(titles[event[1]])
+                elif event[0] == "error":
+                    st.error(f"文件處理中斷，未完成的文件未上傳：{event[1]}")
+
+        # a crashed stage ends the run early; files it left unfinished failed
+        finished = {document["title"] for document in documents}
+        st.session_state.upload_failure += [
+            title for title in titles
+            if title not in finished and title not in st.session_state.upload_failure
+        ]
 
         DocumentManager._sync_to_google_sheets(documents)
+        AnswerCache.get_shared().invalidate_documents(
+            [document["title"] for document in documents],
+            [PineconeManager.tag_namespace(tag)]
+        )
         # response = DocumentManager._summarize(documents)
-        CostManager.update_cost(total_price)
+        CostManager.update_cost(pipeline.total_price)
 
     @staticmethod
     @st.dialog("上傳文件")
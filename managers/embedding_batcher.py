@@ -0,0 +1,292 @@
+import math
+import time
+import bisect
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import openai
+import streamlit as st
+
+from .embedding_manager import EmbeddingCache
+from .llm_manager import LLMManger
+from .text_utils import content_hash, count_tokens, get_model_encoding
+
+# errors worth retrying: rate limits, server errors and dropped connections
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,
+)
+
+
+class RateLimiter:
+    """Requests- and tokens-per-minute budget shared by concurrent callers.
+
+    Both budgets refill continuously. A 429 pauses every caller through
+    `pause()`, since the quota is shared by the whole API key.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        # a request larger than the whole budget waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed = now - self._updated_at
+                self._updated_at = now
+                self._requests = min(
+                    self.requests_per_minute,
+                    self._requests + elapsed * self.requests_per_minute / 60)
+                self._tokens = min(
+                    self.tokens_per_minute,
+                    self._tokens + elapsed * self.tokens_per_minute / 60)
+
+                wait = max(
+                    self._resume_at - now,
+                    (1 - self._requests) * 60 / self.requests_per_minute,
+                    (tokens - self._tokens) * 60 / self.tokens_per_minute,
+                )
+                if wait <= 0:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+class EmbeddingBatcher:
+    """Embed page texts in token-packed batches, several requests at a time.
+
+    Texts already embedded with the same model are served from `cache`,
+    keyed by the SHA-256 of their content, so a page shared by several
+    documents is embedded once. Tokens are
+    counted with the model's own tokenizer, and texts longer than
+    `max_input_tokens` (kept well under the model's 8191-token limit) are
+    split at character boundaries into pieces whose embeddings are
+    averaged, weighted by tokens. Pieces are packed into
+    requests of up to `max_batch_tokens` tokens and sent concurrently under
+    the shared rate limiter; rate limits and server errors are retried with
+    jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        model="text-embedding-3-small",
+        limiter=None,
+        cache=None,
+        max_input_tokens=7500,
+        max_batch_tokens=100000,
+        max_batch_size=2048,
+        concurrency=4,
+        max_retries=6
+    ):
+        self.model = model
+        self.encoding = get_model_encoding(model)
+        self.limiter = limiter
+        self.cache = cache
+        self.max_input_tokens = max_input_tokens
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        # retries are handled here, so they respect the shared limiter
+        self.llm_manager = LLMManger(max_retries=0)
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="embedding")
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "tokens": 0,
+            "split_texts": 0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "tokens_saved": 0,
+            "bytes_saved": 0,
+        }
+
+    @staticmethod
+    @st.cache_resource
+    def get_shared():
+        """Return the batcher shared by every upload of this process."""
+        config = st.secrets.get("ingestion", {})
+        return EmbeddingBatcher(
+            limiter=RateLimiter(
+                config.get("requests_per_minute", 3000),
+                config.get("tokens_per_minute", 1000000)
+            ),
+            cache=EmbeddingCache.get_shared() if config.get("embedding_cache", True) else None,
+            max_input_tokens=config.get("max_input_tokens", 7500),
+            max_batch_tokens=config.get("max_batch_tokens", 100000),
+            concurrency=config.get("embedding_requests", 4),
+            max_retries=config.get("max_retries", 6)
+        )
+
+    def embed(self, texts):
+        """Return one embedding per text, the price of the requests and, per
+        text, whether its embedding came from the cache."""
+        if self.cache is None:
+            vectors, price = self._embed(texts)
+            return vectors, price, [False] * len(texts)
+
+        keys = [content_hash(text) for text in texts]
+        vectors = self.cache.get_many(keys, self.model, remember=False)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        cached = [vector is not None for vector in vectors]
+        with self._lock:
+            self.stats["cache_hits"] += len(texts) - len(missing)
+            self.stats["cache_misses"] += len(missing)
+            for i, vector in enumerate(vectors):
+                if vector is not None:
+                    self.stats["tokens_saved"] += self._tokens(texts[i])
+                    self.stats["bytes_saved"] += len(texts[i].encode("utf-8"))
+        if not missing:
+            return vectors, 0, cached
+
+        new_vectors, price = self._embed([texts[i] for i in missing])
+        for i, vector in zip(missing, new_vectors):
+            vectors[i] = vector
+        self.cache.put_many(
+            [(keys[i], vectors[i]) for i in missing], self.model, remember=False)
+        return vectors, price, cached
+
+    def cache_stats(self):
+        """Hit rate and what the page cache saved, since the process started."""
+        with self._lock:
+            lookups = self.stats["cache_hits"] + self.stats["cache_misses"]
+            return {
+                "hit_rate": self.stats["cache_hits"] / lookups if lookups else 0.0,
+                "tokens_saved": self.stats["tokens_saved"],
+                "bytes_saved": self.stats["bytes_saved"],
+            }
+
+    def _embed(self, texts):
+        pieces = []
+        for i, text in enumerate(texts):
+            split = self._split(text)
+            if len(split) > 1:
+                self._count("split_texts")
+            pieces += [(i, piece, tokens) for piece, tokens in split]
+
+        batches = list(self._pack(pieces))
+        futures = [
+            self._executor.submit(
+                self._request,
+                [piece for _, piece, _ in batch],
+                sum(tokens for _, _, tokens in batch)
+            )
+            for batch in batches
+        ]
+
+        vectors = [0] * len(texts)
+        total_price = 0
+        for batch, future in zip(batches, futures):
+            embeddings, price = future.result()
+            total_price += price
+            for (i, _, tokens), embedding in zip(batch, embeddings):
+                vectors[i] = vectors[i] + np.asarray(embedding) * max(tokens, 1)
+
+        # the index uses dot products, so averaged vectors are renormalized
+        return [(vector / np.linalg.norm(vector)).tolist() for vector in vectors], total_price
+
+    def _tokens(self, text):
+        if self.encoding is None:
+            return count_tokens(text)
+        return len(self.encoding.encode_ordinary(text))
+
+    def _split(self, text):
+        """`(piece, tokens)` pieces of at most `max_input_tokens`, cut between characters."""
+        if self.encoding is None:
+            # the estimate can undercount the model's tokens for CJK text by
+            # about half, so estimated pieces get half the budget
+            tokens = count_tokens(text)
+            limit = max(self.max_input_tokens // 2, 1)
+            if tokens <= limit:
+                return [(text, tokens)]
+            parts = math.ceil(tokens / limit)
+            size = math.ceil(len(text) / parts)
+            return [
+                (text[i: i + size], count_tokens(text[i: i + size]))
+                for i in range(0, len(text), size)
+            ]
+
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) <= self.max_input_tokens:
+            return [(text, len(tokens))]
+
+        # offsets map each token to the character it starts in, so cuts fall
+        # between characters even where a token holds part of a CJK character
+        _, offsets = self.encoding.decode_with_offsets(tokens)
+        pieces, start = [], 0
+        while start < len(text):
+            first = bisect.bisect_left(offsets, start)
+            stop = first + self.max_input_tokens
+            end = offsets[stop] if stop < len(offsets) else len(text)
+            if end <= start:
+                # a single character longer than the budget; keep it whole
+                end = start + 1
+            piece = text[start:end]
+            pieces.append((piece, len(self.encoding.encode_ordinary(piece))))
+            start = end
+        return pieces
+
+    def _pack(self, pieces):
+        batch, batch_tokens = [], 0
+        for piece in pieces:
+            if batch and (
+                batch_tokens + piece[2] > self.max_batch_tokens
+                or len(batch) == self.max_batch_size
+            ):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(piece)
+            batch_tokens += piece[2]
+        if batch:
+            yield batch
+
+    def _request(self, texts, tokens):
+        for attempt in range(self.max_retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire(tokens)
+            try:
+                result = self.llm_manager.get_embeddings(texts, model=self.model)
+                self._count("requests")
+                self._count("tokens", tokens)
+                return result
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                print(f"Embedding request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                self._count("retries")
+                if isinstance(e, openai.RateLimitError) and self.limiter is not None:
+                    self.limiter.pause(delay)
+                time.sleep(delay)
+
+    @staticmethod
+    def _backoff(attempt, error):
+        """Full-jitter exponential backoff, at least the server's Retry-After."""
+        delay = random.uniform(0, min(60, 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            return delay
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
@@ -0,0 +1,263 @@
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from array import array
+from pathlib import Path
+
+import streamlit as st
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from .lru_cache import LRUCache
+from .tracer import span
+from .usage_meter import UsageMeter
+
+
+class EmbeddingCache:
+    """Process-shared embedding cache keyed by (key, model).
+
+    Vectors live in a bounded in-memory LRU and, when `path` is given, in a
+    local SQLite file so they survive restarts. The SQLite table is trimmed
+    to `max_disk_entries` rows, dropping the least recently used vectors.
+    """
+
+    def __init__(self, max_entries=2048, path=None, max_disk_entries=100000):
+        self.memory = LRUCache(max_entries=max_entries)
+        self.max_disk_entries = max_disk_entries
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_entries = 0
+
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT NOT NULL, model TEXT NOT NULL, vector BLOB NOT NULL, "
+                "accessed_at REAL NOT NULL, PRIMARY KEY (key, model))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_embeddings_accessed_at "
+                "ON embeddings (accessed_at)"
+            )
+            self._conn.commit()
+            self._disk_entries = self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    @st.cache_resource
+    def get_shared():
+        """Return the embedding cache shared by every session of this process."""
+        config = st.secrets.get("embedding_cache", {})
+        return EmbeddingCache(
+            max_entries=config.get("max_entries", 2048),
+            path=config.get("path", ".cache/embeddings.sqlite3"),
+            max_disk_entries=config.get("max_disk_entries", 100000)
+        )
+
+    @staticmethod
+    def normalize(text):
+        """Fold width/case/whitespace variants of a query onto one cache key."""
+        text = unicodedata.normalize("NFKC", text).casefold()
+        text = re.sub(r"\s+", " ", text).strip()
+        return text.rstrip("?？。.!！ ")
+
+    @staticmethod
+    def text_key(text):
+        normalized = EmbeddingCache.normalize(text)
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, key, model):
+        vector = self.memory.get((key, model))
+        if vector is not None or self._conn is None:
+            return vector
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE key = ? AND model = ?",
+                (key, model)
+            ).fetchone()
+            if row is None:
+                return None
+
+            self._conn.execute(
+                "UPDATE embeddings SET accessed_at = ? WHERE key = ? AND model = ?",
+                (time.time(), key, model)
+            )
+            self._conn.commit()
+            self.disk_hits += 1
+
+        vector = EmbeddingCache._unpack(row[0])
+        self.memory.put((key, model), vector)
+        return vector
+
+    def get_many(self, keys, model, remember=True):
+        """Look up many keys at once; missing ones are None.
+
+        With `remember=False` (bulk page embeddings) disk hits are not copied
+        into the in-memory LRU, which is kept for query vectors.
+        """
+        vectors = [self.memory.get((key, model)) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if not missing or self._conn is None:
+            return vectors
+
+        rows = {}
+        with self._lock:
+            # stay below SQLite's bound-parameter limit
+            for start in range(0, len(missing), 500):
+                batch = [keys[i] for i in missing[start: start + 500]]
+                placeholders = ",".join("?" * len(batch))
+                rows.update(self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({placeholders})",
+                    [model] + batch
+                ).fetchall())
+                self._conn.execute(
+                    "UPDATE embeddings SET accessed_at = ? "
+                    f"WHERE model = ? AND key IN ({placeholders})",
+                    [time.time(), model] + batch
+                )
+            self._conn.commit()
+            self.disk_hits += len(rows)
+
+        for i in missing:
+            if keys[i] in rows:
+                vectors[i] = EmbeddingCache._unpack(rows[keys[i]])
+                if remember:
+                    self.memory.put((keys[i], model), vectors[i])
+        return vectors
+
+    def put(self, key, model, vector):
+        self.put_many([(key, vector)], model)
+
+    def put_many(self, items, model, remember=True):
+        if remember or self._conn is None:
+            for key, vector in items:
+                self.memory.put((key, model), vector)
+
+        if self._conn is None or not items:
+            return
+
+        now = time.time()
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, model, vector, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(key, model, EmbeddingCache._pack(vector), now) for key, vector in items]
+            )
+            self._disk_entries += self._conn.total_changes - before
+            overflow = self._disk_entries - self.max_disk_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN ("
+                    "SELECT rowid FROM embeddings ORDER BY accessed_at LIMIT ?)",
+                    (overflow,)
+                )
+                self._disk_entries -= overflow
+            self._conn.commit()
+
+    def stats(self):
+        memory_stats = self.memory.stats()
+        # every memory miss falls through to disk, so disk hits are a subset
+        misses = memory_stats["misses"] - self.disk_hits
+        lookups = memory_stats["hits"] + memory_stats["misses"]
+        return {
+            "memory_entries": memory_stats["size"],
+            "disk_entries": self._disk_entries,
+            "memory_hits": memory_stats["hits"],
+            "disk_hits": self.disk_hits,
+            "misses": misses,
+            "hit_rate": (lookups - misses) / lookups if lookups else 0.0,
+        }
+
+    @staticmethod
+    def _pack(vector):
+        return array("f", vector).tobytes()
+
+    @staticmethod
+    def _unpack(blob):
+        vector = array("f")
+        vector.frombytes(blob)
+        return vector.tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that answers repeated texts from an EmbeddingCache.
+
+    Misses of an `OpenAIEmbeddings` model are sent through its OpenAI client
+    directly, so the turn is metered with the usage the API returns.
+    """
+
+    def __init__(self, embeddings, cache, model):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+
+    def embed_query(self, text):
+        with span("embedding", model=self.model) as traced:
+            key = EmbeddingCache.text_key(text)
+            vector = self.cache.get(key, self.model)
+            traced.set(cache_hit=vector is not None)
+            if vector is None:
+                vector = self._embed([text])[0]
+                self.cache.put(key, self.model, vector)
+        return vector
+
+    async def aembed_query(self, text):
+        with span("embedding", model=self.model) as traced:
+            key = EmbeddingCache.text_key(text)
+            vector = self.cache.get(key, self.model)
+            traced.set(cache_hit=vector is not None)
+            if vector is None:
+                vector = (await self._aembed([text]))[0]
+                self.cache.put(key, self.model, vector)
+        return vector
+
+    def embed_documents(self, texts):
+        keys = [EmbeddingCache.text_key(text) for text in texts]
+        vectors = [self.cache.get(key, self.model) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        if missing:
+            new_vectors = self._embed([texts[i] for i in missing])
+            for i, vector in zip(missing, new_vectors):
+                vectors[i] = vector
+            self.cache.put_many(
+                [(keys[i], vectors[i]) for i in missing], self.model)
+
+        return vectors
+
+    def _embed(self, texts):
+        if isinstance(self.embeddings, OpenAIEmbeddings):
+            response = self.embeddings.client.create(
+                input=texts, **self.embeddings._invocation_params)
+            CachedEmbeddings._meter(self.model, texts, response.usage.prompt_tokens)
+            return [d.embedding for d in response.data]
+
+        vectors = self.embeddings.embed_documents(texts)
+        CachedEmbeddings._meter(self.model, texts)
+        return vectors
+
+    async def _aembed(self, texts):
+        if isinstance(self.embeddings, OpenAIEmbeddings):
+            response = await self.embeddings.async_client.create(
+                input=texts, **self.embeddings._invocation_params)
+            CachedEmbeddings._meter(self.model, texts, response.usage.prompt_tokens)
+            return [d.embedding for d in response.data]
+
+        vectors = await self.embeddings.aembed_documents(texts)
+        CachedEmbeddings._meter(self.model, texts)
+        return vectors
+
+    @staticmethod
+    def _meter(model, texts, tokens=None):
+        # only API calls are billed, so cache hits are not reported
+        meter = UsageMeter.current()
+        if meter is not None:
+            meter.record_embedding(model, texts, tokens)
@@ -0,0 +1,301 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+from sqlalchemy import create_engine, func, select, text
+from langchain_core.messages import HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables.config import run_in_executor
+from langchain_community.chat_message_histories import SQLChatMessageHistory
+from langchain_community.chat_message_histories.sql import DefaultMessageConverter
+
+from .cost_manager import CostManager
+from .lru_cache import LRUCache
+from .model_registry import ModelRegistry
+from .text_utils import count_tokens
+from .usage_meter import STAGE_TAG_PREFIX, UsageMeter
+
+summary_prompt = ChatPromptTemplate.from_messages([
+    ("system", (
+        "You maintain a running summary of a conversation between a user and "
+        "an assistant that answers questions about government documents. "
+        "Extend the existing summary with the new messages. Keep the facts, "
+        "agencies, document names, numbers and open questions the user may "
+        "refer back to. Write the summary in traditional Chinese and keep it "
+        "under 300 words."
+    )),
+    ("human", "Existing summary:\n{summary}\n\nNew messages:\n{conversation}"),
+])
+
+
+class WindowedChatMessageHistory(SQLChatMessageHistory):
+    """SQL chat history that only loads the most recent part of a dialog.
+
+    At most `max_messages` rows are read (newest first, through the
+    (session_id, id) index) and older messages are dropped once `max_tokens`
+    of history is reached, so prompt size stays flat for long dialogs.
+    Messages already folded into the session's rolling summary are skipped
+    and the summary is prepended as a user message instead. After
+    `preload()`, reads are served from the loaded window until the next
+    write, so a turn that inspects the history before running the chain
+    reads it once.
+    """
+
+    def __init__(self, session_id, engine, converter, max_messages=None, max_tokens=None):
+        super().__init__(
+            session_id,
+            connection=engine,
+            custom_message_converter=converter
+        )
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.truncated_messages = 0
+        self._preloaded = None
+
+    def _create_table_if_not_exists(self):
+        # the table and its index are created once per engine by HistoryManager
+        self._table_created = True
+
+    @property
+    def messages(self):
+        if self._preloaded is not None:
+            return list(self._preloaded)
+        return self._read_messages()
+
+    def preload(self):
+        self._preloaded = self._read_messages()
+        return list(self._preloaded)
+
+    def _read_messages(self):
+        model = self.sql_model_class
+        session_filter = getattr(model, self.session_id_field_name) == self.session_id
+        with self._make_sync_session() as session:
+            summary = session.execute(
+                text(
+                    "SELECT summary, covered_id FROM message_summary "
+                    "WHERE session_id = :session_id"
+                ),
+                {"session_id": self.session_id}
+            ).first()
+            if summary is not None:
+                session_filter = session_filter & (model.id > summary.covered_id)
+
+            query = select(model).where(session_filter).order_by(model.id.desc())
+            if self.max_messages is not None:
+                query = query.limit(self.max_messages)
+            records = session.execute(query).scalars().all()
+            total = session.execute(
+                select(func.count()).select_from(model).where(session_filter)
+            ).scalar()
+
+        messages = []
+        tokens = 0
+        for record in records:
+            message = self.converter.from_sql_model(record)
+            message_tokens = count_tokens(str(message.content))
+            if self.max_tokens is not None and messages and tokens + message_tokens > self.max_tokens:
+                break
+            messages.append(message)
+            tokens += message_tokens
+        messages.reverse()
+
+        # the window must open on a user turn
+        while messages and messages[0].type != "human":
+            tokens -= count_tokens(str(messages.pop(0).content))
+
+        self.truncated_messages = total - len(messages)
+        HistoryManager.record_window(self.session_id, {
+            "loaded_messages": len(messages),
+            "truncated_messages": self.truncated_messages,
+            "history_tokens": tokens,
+            "summarized": summary is not None,
+        })
+
+        if summary is not None:
+            # a user message, since Anthropic rejects system messages mid-dialog
+            messages.insert(0, HumanMessage(
+                content=f"Summary of the earlier conversation:\n{summary.summary}"
+            ))
+        return messages
+
+    async def aget_messages(self):
+        # the pooled engine is synchronous, so run the query in a worker thread
+        return await run_in_executor(None, lambda: self.messages)
+
+    def add_message(self, message):
+        self._preloaded = None
+        super().add_message(message)
+
+    def add_messages(self, messages):
+        self._preloaded = None
+        super().add_messages(messages)
+
+    async def aadd_messages(self, messages):
+        await run_in_executor(None, self.add_messages, messages)
+
+    def clear(self):
+        self._preloaded = None
+        super().clear()
+        with self._make_sync_session() as session:
+            session.execute(
+                text("DELETE FROM message_summary WHERE session_id = :session_id"),
+                {"session_id": self.session_id}
+            )
+            session.commit()
+
+
+class HistoryManager:
+    table_name = "message_store"
+
+    @staticmethod
+    @st.cache_resource
+    def get_engine():
+        """Pooled SQLAlchemy engine shared by every history of this process."""
+        config = st.secrets.get("history", {})
+        engine = create_engine(config.get("url", "sqlite:///memory.db"))
+
+        converter = HistoryManager.get_converter()
+        converter.get_sql_model_class().metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_{HistoryManager.table_name}_session_id "
+                f"ON {HistoryManager.table_name} (session_id, id)"
+            ))
+            # rolling summary of the messages up to covered_id of each session
+            connection.execute(text(
+                "CREATE TABLE IF NOT EXISTS message_summary ("
+                "session_id TEXT PRIMARY KEY, summary TEXT NOT NULL, "
+                "covered_id INTEGER NOT NULL)"
+            ))
+        return engine
+
+    @staticmethod
+    @st.cache_resource
+    def get_converter():
+        # building the converter declares a new SQLAlchemy model, so share it
+        return DefaultMessageConverter(HistoryManager.table_name)
+
+    @staticmethod
+    @st.cache_resource
+    def get_window_stats():
+        """Most recent history window loaded for each session."""
+        return LRUCache(max_entries=1024)
+
+    @staticmethod
+    def record_window(session_id, stats):
+        HistoryManager.get_window_stats().put(session_id, stats)
+
+    @staticmethod
+    def get_session_history(session_id):
+        config = st.secrets.get("history", {})
+        max_turns = config.get("max_turns", 10)
+        return WindowedChatMessageHistory(
+            session_id,
+            HistoryManager.get_engine(),
+            HistoryManager.get_converter(),
+            max_messages=2 * max_turns if max_turns else None,
+            max_tokens=config.get("max_tokens", 4000)
+        )
+
+    @staticmethod
+    @st.cache_resource
+    def get_compaction_executor():
+        # summaries are written off the answer path, one worker is plenty
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-compaction")
+
+    _compacting = set()
+    _compacting_lock = threading.Lock()
+
+    @staticmethod
+    def schedule_compaction(session_id):
+        """Fold old turns of a long dialog into its summary in the background.
+
+        The summary call is billed to the owner of the current turn's meter.
+        """
+        config = st.secrets.get("history", {})
+        if not config.get("compaction", False):
+            return
+
+        with HistoryManager._compacting_lock:
+            if session_id in HistoryManager._compacting:
+                return
+            HistoryManager._compacting.add(session_id)
+
+        meter = UsageMeter.current()
+        llm = ModelRegistry.get_chat_model(
+            config.get("summary_model", "gpt-4o-mini"), 0, max_tokens=1024)
+        HistoryManager.get_compaction_executor().submit(
+            HistoryManager.compact,
+            session_id,
+            llm,
+            HistoryManager.get_engine(),
+            threshold_tokens=config.get("compaction_threshold_tokens", 3000),
+            keep_turns=config.get("compaction_keep_turns", 4),
+            owner=meter.owner if meter is not None else None
+        )
+
+    @staticmethod
+    def compact(session_id, llm, engine, threshold_tokens, keep_turns, owner=None):
+        try:
+            with UsageMeter.track(owner) as meter:
+                HistoryManager._compact(session_id, llm, engine, threshold_tokens, keep_turns)
+            if owner is not None and meter.total_cost:
+                CostManager.update_cost(meter.total_cost, *owner)
+        except Exception as e:
+            print(f"Cannot compact history of {session_id}:", str(e))
+        finally:
+            with HistoryManager._compacting_lock:
+                HistoryManager._compacting.discard(session_id)
+
+    @staticmethod
+    def _compact(session_id, llm, engine, threshold_tokens, keep_turns):
+        converter = HistoryManager.get_converter()
+        model = converter.get_sql_model_class()
+
+        with engine.connect() as connection:
+            summary = connection.execute(
+                text(
+                    "SELECT summary, covered_id FROM message_summary "
+                    "WHERE session_id = :session_id"
+                ),
+                {"session_id": session_id}
+            ).first()
+            covered_id = summary.covered_id if summary is not None else 0
+            records = connection.execute(
+                select(model.__table__)
+                .where(model.session_id == session_id, model.id > covered_id)
+                .order_by(model.id.asc())
+            ).all()
+
+        messages = [(record.id, converter.from_sql_model(record)) for record in records]
+        tokens = sum(count_tokens(str(message.content)) for _, message in messages)
+        if tokens <= threshold_tokens:
+            return
+
+        # keep the latest turns verbatim and fold everything before them
+        fold = messages[:max(len(messages) - 2 * keep_turns, 0)]
+        while fold and fold[-1][1].type == "human":
+            fold.pop()
+        if not fold:
+            return
+
+        conversation = "\n".join(
+            f"{message.type}: {message.content}" for _, message in fold)
+        new_summary = llm.invoke(
+            summary_prompt.format_messages(
+                summary=summary.summary if summary is not None else "(none)",
+                conversation=conversation
+            ),
+            config={"tags": [f"{STAGE_TAG_PREFIX}compaction"]}
+        ).content
+
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    "INSERT INTO message_summary (session_id, summary, covered_id) "
+                    "VALUES (:session_id, :summary, :covered_id) "
+                    "ON CONFLICT (session_id) DO UPDATE SET "
+                    "summary = excluded.summary, covered_id = excluded.covered_id"
+                ),
+                {"session_id": session_id, "summary": new_summary, "covered_id": fold[-1][0]}
+            )
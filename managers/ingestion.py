@@ -0,0 +1,470 @@
+import io
+import os
+import time
+import queue
+import shutil
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import PyPDF2
+
+from .embedding_batcher import EmbeddingBatcher
+from .pinecone_manager import PineconeManager
+from .tracer import span
+
+# stage statistics of the most recent ingestion runs of this process
+ingestion_log = deque(maxlen=100)
+
+# end-of-stream marker passed down the stage queues
+_DONE = object()
+
+
+def extract_page_range(path, start, stop):
+    """Extract the text of pages [start, stop) of the PDF at `path`; runs in a
+    worker process, so only the path and the range cross the process boundary."""
+    reader = PyPDF2.PdfReader(path)
+    return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+
+def page_records(tag, name, texts, start=0):
+    """`{tag, name, page, content}` records of extracted pages, skipping near-empty ones."""
+    data = []
+    for i, content in enumerate(texts, start=start):
+        clean_content = content.encode('utf-8', 'replace').decode('utf-8')
+
+        if len(content) < 10:
+            continue
+
+        data.append({
+            "tag": tag,
+            "name": name,
+            "page": i + 1,
+            "content": clean_content,
+        })
+
+    return data
+
+
+class StageStats:
+    """Where one pipeline stage spends its time.
+
+    `busy` is time spent on its own work, `starved` waiting for input from
+    the previous stage and `blocked` waiting for room in the next stage's
+    queue. A stage that is busy most of the time is the bottleneck.
+    """
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, kind):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                setattr(self, kind, getattr(self, kind) + time.perf_counter() - started_at)
+
+    def get(self, source):
+        with self.timed("starved"):
+            return source.get()
+
+    def put(self, target, item):
+        with self.timed("blocked"):
+            target.put(item)
+
+    def summary(self, wall):
+        return {
+            "items": self.items,
+            "busy_s": round(self.busy, 3),
+            "starved_s": round(self.starved, 3),
+            "blocked_s": round(self.blocked, 3),
+            "utilization": round(self.busy / (wall * self.workers), 3) if wall else 0,
+        }
+
+
+class IngestionPipeline:
+    """Extract → embed → upsert, with the stages of different files overlapping.
+
+    Each file is written once to a temporary directory and its page ranges
+    are extracted from there on the process pool, then batched and embedded on
+    `embedding_workers` threads through the shared `EmbeddingBatcher`, and
+    upserted into `namespace` by one writer thread. Each file gets a new
+    document key for its vector ids (see `PineconeManager.generate_unique_id`),
+    so a page shared by two documents is stored for each with its own
+    metadata, while its embedding is reused from the batcher's content-keyed
+    cache. Stages are connected by queues of `queue_size` items, so
+    memory is bounded by the queues rather than by the upload. Once a file
+    fails in any stage, its remaining pages are neither extracted nor
+    embedded. A worker crash breaks the whole process pool: the files it
+    held fail and `renew_pool(broken)` supplies the pool for the rest.
+    `run()` yields progress events on the calling thread, which is the only
+    one touching Streamlit.
+    """
+
+    def __init__(
+        self,
+        pool,
+        index,
+        tag,
+        namespace,
+        extraction_workers=4,
+        pages_per_task=8,
+        batch_size=64,
+        embedding_workers=2,
+        queue_size=8,
+        batcher=None,
+        renew_pool=None
+    ):
+        self.pool = pool
+        self.renew_pool = renew_pool
+        self.index = index
+        self.tag = tag
+        self.namespace = namespace
+        self.extraction_workers = extraction_workers
+        self.pages_per_task = pages_per_task
+        self.batch_size = batch_size
+        self.embedding_workers = embedding_workers
+        self.queue_size = queue_size
+        self.pages = {"embedded": 0, "cached": 0}
+        self.batcher = batcher or EmbeddingBatcher.get_shared()
+        self.total_price = 0
+        # error of each failed file, shared by the stages
+        self.failed = {}
+        self.stats = {
+            "extract": StageStats("extract"),
+            "embed": StageStats("embed", embedding_workers),
+            "upsert": StageStats("upsert"),
+        }
+
+    def run(self, files):
+        """Ingest `(name, bytes)` PDFs, yielding events as they happen:
+
+        - `("pages", n)`: n more pages were found in the files
+        - `("done", n)`: n more pages are stored, skipped as empty or failed
+        - `("document", i, record)`: file i is stored; `record` has its
+          title, content, vector ids and how many pages were embedded anew
+          or had their embedding reused from the cache
+        - `("failed", i, error)`: file i could not be ingested
+        - `("error", error)`: a stage crashed; the run ends early and files
+          it left unfinished are not reported
+        """
+        pages = queue.Queue(maxsize=self.queue_size)
+        vectors = queue.Queue(maxsize=self.queue_size)
+        events = queue.Queue()
+        started_at = time.perf_counter()
+        self.document_keys = [PineconeManager.new_document_key() for _ in files]
+
+        threads = [
+            threading.Thread(target=self._guard, args=(
+                self._extract, events, None, pages, files, pages, events)),
+            threading.Thread(target=self._guard, args=(
+                self._embed, events, pages, vectors, pages, vectors)),
+            threading.Thread(target=self._guard, args=(
+                self._upsert, events, vectors, events, vectors, files, events)),
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            event = events.get()
+            if event is _DONE:
+                break
+            yield event
+
+        for thread in threads:
+            thread.join()
+
+        wall = time.perf_counter() - started_at
+        summary = {
+            "files": len(files),
+            "seconds": round(wall, 3),
+            "stages": {name: stats.summary(wall) for name, stats in self.stats.items()},
+            "pages": dict(self.pages),
+            "embedding": dict(self.batcher.stats),
+        }
+        ingestion_log.append(summary)
+
+    @staticmethod
+    def _guard(stage, events, upstream, downstream, *args):
+        """Run a stage; if it crashes, report it, end the downstream stream and
+        drain the upstream one so the earlier stages are not blocked forever."""
+        try:
+            stage(*args)
+        except Exception as e:
+            print(f"Ingestion stage {stage.__name__} failed:", str(e))
+            events.put(("error", e))
+            downstream.put(_DONE)
+            while upstream is not None and upstream.get() is not _DONE:
+                pass
+
+    def _extract(self, files, pages, events):
+        """Submit page ranges to the process pool, keeping a bounded window in flight
+        and emitting the results in page order."""
+        stats = self.stats["extract"]
+        in_flight = deque()
+        # workers read the files from disk instead of receiving their bytes
+        # with every page range
+        workdir = tempfile.mkdtemp(prefix="ingestion-")
+
+        def path_of(i):
+            return os.path.join(workdir, f"{i}.pdf")
+
+        def submit(i, start, stop):
+            try:
+                return self.pool, self.pool.submit(extract_page_range, path_of(i), start, stop)
+            except BrokenProcessPool:
+                self._renew_pool(self.pool)
+                return self.pool, self.pool.submit(extract_page_range, path_of(i), start, stop)
+
+        def emit_oldest():
+            i, name, start, stop, pool, future = in_flight.popleft()
+            if future is None:
+                if os.path.exists(path_of(i)):
+                    os.remove(path_of(i))
+                stats.put(pages, ("end", i))
+                return
+            if i in self.failed:
+                # the file failed elsewhere; its other ranges are not needed
+                future.cancel()
+                stats.put(pages, ("failed", i, self.failed[i], stop - start))
+                return
+            with stats.timed("busy"):
+                try:
+                    texts = future.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        self._renew_pool(pool)
+                    self.failed.setdefault(i, e)
+                    stats.put(pages, ("failed", i, e, stop - start))
+                    return
+            stats.items += len(texts)
+            records = page_records(self.tag, name, texts, start)
+            events.put(("done", len(texts) - len(records)))
+            stats.put(pages, ("pages", i, records))
+
+        try:
+            for i, (name, bytes_data) in enumerate(files):
+                try:
+                    page_count = len(PyPDF2.PdfReader(io.BytesIO(bytes_data)).pages)
+                except Exception as e:
+                    stats.put(pages, ("failed", i, e, 0))
+                    continue
+                events.put(("pages", page_count))
+                with open(path_of(i), "wb") as f:
+                    f.write(bytes_data)
+
+                for start in range(0, page_count, self.pages_per_task):
+                    if i in self.failed:
+                        stats.put(pages, ("failed", i, self.failed[i], page_count - start))
+                        break
+                    stop = min(start + self.pages_per_task, page_count)
+                    in_flight.append((i, name, start, stop, *submit(i, start, stop)))
+                    while len(in_flight) > 2 * self.extraction_workers:
+                        emit_oldest()
+                # the file's end marker follows its last page range
+                in_flight.append((i, name, page_count, page_count, None, None))
+
+            while in_flight:
+                emit_oldest()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        stats.put(pages, _DONE)
+
+    def _embed(self, pages, vectors):
+        """Batch page records across files and embed up to `embedding_workers`
+        batches at a time, passing results and file markers on in order."""
+        stats = self.stats["embed"]
+        in_flight = deque()
+        batch = []
+        markers = []
+
+        def embed(records):
+            """Embeddings aligned with `records`, their price and whether each
+            was served from the cache."""
+            with stats.timed("busy"), span("ingest.embed", pages=len(records)) as traced:
+                embeddings, price, cached = self.batcher.embed(
+                    [record["content"] for record in records])
+                traced.set(cached=sum(cached))
+                return embeddings, cached, price
+
+        def submit(executor):
+            nonlocal batch
+            if batch:
+                in_flight.append(("vectors", batch, executor.submit(embed, batch)))
+                batch = []
+            # markers follow the batch holding the file's last pages
+            in_flight.extend(("marker", marker, None) for marker in markers)
+            markers.clear()
+
+        def forward_oldest():
+            kind, payload, future = in_flight.popleft()
+            if kind != "vectors":
+                stats.put(vectors, payload)
+                return
+            try:
+                embeddings, cached, price = future.result()
+            except Exception as e:
+                records_by_file = {}
+                for record in payload:
+                    records_by_file.setdefault(record["file"], []).append(record)
+                if len(records_by_file) == 1:
+                    print("Cannot embed ingestion batch:", str(e))
+                    self.failed.setdefault(payload[0]["file"], e)
+                    stats.put(vectors, ("failed", payload[0]["file"], e, len(payload)))
+                    return
+
+                # batches span files, so retry file by file and only fail
+                # the files that still cannot be embedded on their own
+                print("Cannot embed ingestion batch, retrying file by file:", str(e))
+                for i, records in records_by_file.items():
+                    try:
+                        embeddings, cached, price = embed(records)
+                    except Exception as e:
+                        print("Cannot embed ingestion batch:", str(e))
+                        self.failed.setdefault(i, e)
+                        stats.put(vectors, ("failed", i, e, len(records)))
+                        continue
+                    stats.items += len(records)
+                    stats.put(vectors, ("vectors", records, embeddings, cached, price))
+                return
+            stats.items += len(payload)
+            stats.put(vectors, ("vectors", payload, embeddings, cached, price))
+
+        with ThreadPoolExecutor(max_workers=self.embedding_workers) as executor:
+            while True:
+                item = stats.get(pages)
+                if item is _DONE:
+                    break
+
+                kind, i, *rest = item
+                if kind == "pages" and i in self.failed:
+                    # pages of a failed file are not embedded (or billed)
+                    stats.put(vectors, ("failed", i, self.failed[i], len(rest[0])))
+                elif kind == "pages":
+                    for record in rest[0]:
+                        batch.append({**record, "file": i})
+                        if len(batch) == self.batch_size:
+                            submit(executor)
+                elif batch:
+                    # batches span files; the marker waits for the current one
+                    markers.append(item)
+                else:
+                    in_flight.append(("marker", item, None))
+
+                while sum(kind == "vectors" for kind, _, _ in in_flight) > self.embedding_workers:
+                    forward_oldest()
+
+            submit(executor)
+            while in_flight:
+                forward_oldest()
+        stats.put(vectors, _DONE)
+
+    def _upsert(self, vectors, files, events):
+        """Write vectors and lexical postings, and report each finished file.
+
+        Vectors written for a file that fails later, or that a crashed stage
+        leaves unfinished, are deleted again so no orphans stay in the index.
+        """
+        stats = self.stats["upsert"]
+        documents = {}
+        failed = set()
+
+        while True:
+            item = stats.get(vectors)
+            if item is _DONE:
+                break
+
+            kind, *rest = item
+            if kind == "vectors":
+                records, embeddings, cached, price = rest
+                self.total_price += price
+                records_by_file = {}
+                for record, embedding, hit in zip(records, embeddings, cached):
+                    if record["file"] not in failed and record["file"] not in self.failed:
+                        records_by_file.setdefault(record["file"], []).append(
+                            (record, embedding, hit))
+
+                with stats.timed("busy"), span("ingest.upsert", pages=len(records)):
+                    for i, batch in records_by_file.items():
+                        docs = [
+                            {key: value for key, value in record.items() if key != "file"}
+                            for record, _, _ in batch
+                        ]
+                        ids = [
+                            PineconeManager.generate_unique_id(
+                                self.document_keys[i], doc["content"])
+                            for doc in docs
+                        ]
+                        PineconeManager.upsert_batch(
+                            self.index,
+                            ids,
+                            docs,
+                            [embedding for _, embedding, _ in batch],
+                            self.namespace
+                        )
+                        cached_pages = sum(hit for _, _, hit in batch)
+                        document = documents.setdefault(
+                            i, {"ids": [], "contents": [], "embedded": 0, "cached": 0})
+                        document["ids"] += ids
+                        document["contents"] += [doc["content"] for doc in docs]
+                        document["embedded"] += len(docs) - cached_pages
+                        document["cached"] += cached_pages
+                        self.pages["embedded"] += len(docs) - cached_pages
+                        self.pages["cached"] += cached_pages
+                stats.items += len(records)
+                events.put(("done", len(records)))
+            elif kind == "failed":
+                i, error, pages = rest
+                events.put(("done", pages))
+                if i not in failed:
+                    failed.add(i)
+                    self._discard(documents.pop(i, None))
+                    events.put(("failed", i, error))
+            elif kind == "end":
+                i = rest[0]
+                if i in failed:
+                    continue
+                document = documents.pop(
+                    i, {"ids": [], "contents": [], "embedded": 0, "cached": 0})
+                events.put(("document", i, {
+                    "title": files[i][0],
+                    "content": "".join(document["contents"]),
+                    "vectors": document["ids"],
+                    "embedded_pages": document["embedded"],
+                    "cached_pages": document["cached"],
+                }))
+
+        # the stream ended early: files still open will never be reported
+        for document in documents.values():
+            self._discard(document)
+        events.put(_DONE)
+
+    def _renew_pool(self, broken):
+        """Switch to a working pool after `broken` lost a worker."""
+        if self.renew_pool is not None and self.pool is broken:
+            self.pool = self.renew_pool(broken)
+
+    def _discard(self, document):
+        """Delete the vectors already written for a file that did not finish."""
+        if not document:
+            return
+        self.pages["embedded"] -= document["embedded"]
+        self.pages["cached"] -= document["cached"]
+        if not document["ids"]:
+            return
+        try:
+            PineconeManager.delete_batch(self.index, document["ids"], self.namespace)
+        except Exception as e:
+            print("Cannot delete vectors of a failed file:", str(e))
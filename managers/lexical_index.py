@@ -0,0 +1,212 @@
+import math
+import sqlite3
+import threading
+from pathlib import Path
+from collections import Counter
+
+import streamlit as st
+from langchain_core.documents import Document
+
+from .rerank_manager import BM25_B, BM25_K1
+from .text_utils import lexical_terms
+
+# metadata fields that can be used in search filters
+FILTER_FIELDS = ("namespace", "tag", "name")
+
+
+class LexicalIndex:
+    """BM25 inverted index over page content, persisted in a local SQLite file.
+
+    Pages are indexed with the same `{tag, name, page, content}` records that
+    are upserted to the vector store, under the same namespace and vector
+    ids, so lexical hits can be fused with vector hits.
+    """
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "id INTEGER PRIMARY KEY, vector_id TEXT UNIQUE NOT NULL, tag TEXT, "
+            "name TEXT, page INTEGER, length INTEGER NOT NULL, content TEXT NOT NULL, "
+            "namespace TEXT);"
+            "CREATE INDEX IF NOT EXISTS ix_documents_name ON documents (name);"
+            "CREATE INDEX IF NOT EXISTS ix_documents_tag ON documents (tag);"
+            # clustered by term, so a lookup reads one contiguous posting list
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "term TEXT NOT NULL, doc INTEGER NOT NULL, tf INTEGER NOT NULL, "
+            "PRIMARY KEY (term, doc)) WITHOUT ROWID;"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(documents)")]
+        if "namespace" not in columns:
+            # pages indexed before per-user namespaces get theirs when the
+            # owner's vectors are migrated
+            self._conn.execute("ALTER TABLE documents ADD COLUMN namespace TEXT")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_documents_namespace ON documents (namespace)")
+        self._conn.commit()
+        self._count, self._total_length = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM documents").fetchone()
+
+    @staticmethod
+    def is_enabled():
+        return st.secrets.get("lexical_index", {}).get("enabled", False)
+
+    @staticmethod
+    @st.cache_resource
+    def get_shared():
+        """Return the lexical index shared by every session of this process."""
+        config = st.secrets.get("lexical_index", {})
+        return LexicalIndex(config.get("path", ".cache/lexical_index.sqlite3"))
+
+    def add_documents(self, ids, documents, namespace=None):
+        """Index pages given as `{tag, name, page, content}` records."""
+        with self._lock:
+            for vector_id, doc in zip(ids, documents):
+                counts = Counter(lexical_terms(doc["content"]))
+                length = sum(counts.values())
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO documents "
+                    "(vector_id, namespace, tag, name, page, length, content) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (vector_id, namespace, doc["tag"], doc["name"], doc["page"], length,
+                     doc["content"])
+                )
+                if cursor.rowcount == 0:
+                    continue
+
+                self._conn.executemany(
+                    "INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)",
+                    [(term, cursor.lastrowid, tf) for term, tf in counts.items()]
+                )
+                self._count += 1
+                self._total_length += length
+            self._conn.commit()
+
+    def delete(self, ids):
+        with self._lock:
+            for vector_id in ids:
+                row = self._conn.execute(
+                    "SELECT id, length FROM documents WHERE vector_id = ?",
+                    (vector_id,)
+                ).fetchone()
+                if row is None:
+                    continue
+
+                self._conn.execute("DELETE FROM postings WHERE doc = ?", (row[0],))
+                self._conn.execute("DELETE FROM documents WHERE id = ?", (row[0],))
+                self._count -= 1
+                self._total_length -= row[1]
+            self._conn.commit()
+
+    def move(self, ids, namespace, tag):
+        """Move the pages `ids` to another namespace and tag."""
+        with self._lock:
+            # stay below SQLite's bound-parameter limit
+            for i in range(0, len(ids), 500):
+                batch = ids[i: i + 500]
+                self._conn.execute(
+                    "UPDATE documents SET namespace = ?, tag = ? "
+                    f"WHERE vector_id IN ({','.join('?' * len(batch))})",
+                    [namespace, tag] + batch
+                )
+            self._conn.commit()
+
+    def search(self, query, k=20, filter=None):
+        """Return the top `k` pages for `query` by BM25, as scored Documents."""
+        terms = list(set(lexical_terms(query)))
+        if not terms or self._count == 0:
+            return []
+
+        where, params = LexicalIndex._filter_clause(filter)
+        placeholders = ",".join("?" * len(terms))
+        avg_length = self._total_length / self._count
+
+        with self._lock:
+            df = dict(self._conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) "
+                "GROUP BY term",
+                terms
+            ).fetchall())
+            rows = self._conn.execute(
+                "SELECT p.term, p.doc, p.tf, d.length FROM postings p "
+                f"JOIN documents d ON d.id = p.doc WHERE p.term IN ({placeholders}){where}",
+                terms + params
+            ).fetchall()
+
+        scores = Counter()
+        for term, doc, tf, length in rows:
+            idf = math.log(1 + (self._count - df[term] + 0.5) / (df[term] + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+            scores[doc] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        top = scores.most_common(k)
+        if not top:
+            return []
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, vector_id, tag, name, page, content FROM documents "
+                f"WHERE id IN ({','.join('?' * len(top))})",
+                [doc for doc, _ in top]
+            ).fetchall()
+        by_id = {row[0]: row for row in rows}
+
+        return [
+            Document(
+                id=by_id[doc][1],
+                page_content=by_id[doc][5],
+                metadata={
+                    "tag": by_id[doc][2],
+                    "name": by_id[doc][3],
+                    "page": by_id[doc][4],
+                    "lexical_score": score,
+                }
+            )
+            for doc, score in top
+        ]
+
+    @staticmethod
+    def _filter_clause(filter):
+        """Translate the `{"field": {"$in"/"$eq": ...}}` filters used with Pinecone."""
+        clauses, params = [], []
+        for field, condition in (filter or {}).items():
+            if field not in FILTER_FIELDS:
+                raise ValueError(f"Unsupported lexical filter field: {field}")
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for op, value in condition.items():
+                if op == "$eq":
+                    clauses.append(f"d.{field} = ?")
+                    params.append(value)
+                elif op == "$in":
+                    if not value:
+                        clauses.append("0")
+                        continue
+                    clauses.append(f"d.{field} IN ({','.join('?' * len(value))})")
+                    params.extend(value)
+                else:
+                    raise ValueError(f"Unsupported lexical filter operator: {op}")
+
+        where = "".join(f" AND {clause}" for clause in clauses)
+        return where, params
+
+
+def reciprocal_rank_fusion(result_lists, k=60):
+    """Fuse ranked Document lists by RRF, identifying pages by id or (name, page)."""
+    scores = Counter()
+    documents = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = doc.id or (doc.metadata.get("name"), doc.metadata.get("page"))
+            scores[key] += 1 / (k + rank + 1)
+            documents.setdefault(key, doc)
+
+    fused = []
+    for key, score in scores.most_common():
+        doc = documents[key]
+        doc.metadata["score"] = score
+        fused.append(doc)
+    return fused
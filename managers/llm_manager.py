@@ -4,8 +4,9 @@ from .cost_manager import CostManager
 
 
 class LLMManger:
-    def __init__(self):
-        self.openai_client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    def __init__(self, max_retries=2):
+        self.openai_client = OpenAI(
+            api_key=st.secrets["OPENAI_API_KEY"], max_retries=max_retries)
 
     def get_embeddings(self, texts, model="text-embedding-3-small"):
         response = self.openai_client.embeddings.create(
@@ -0,0 +1,120 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUCache:
+    """Thread-safe LRU cache with optional TTL expiry and hit/miss counters.
+
+    Streamlit serves every session from its own script thread, so process-wide
+    caches (usually created behind `st.cache_resource`) must guard their state.
+    """
+
+    def __init__(self, max_entries=128, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        # values being built by get_or_create, so concurrent misses wait for one build
+        self._building = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _is_expired(self, stored_at):
+        return self.ttl is not None and time.monotonic() - stored_at > self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._is_expired(entry[1]):
+                if entry is not None:
+                    del self._data[key]
+                    self.evictions += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """Return a live entry without touching recency or the counters."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._is_expired(entry[1]):
+                return default
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_create(self, key, factory):
+        """Return the cached value for `key`, building it with `factory()` on a miss.
+
+        `factory()` runs outside the cache lock, so lookups of other keys are
+        not blocked while it runs; concurrent misses of the same key wait for
+        the one build in progress.
+        """
+        with self._lock:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            future = self._building.get(key)
+            if future is None:
+                future = self._building[key] = Future()
+                building = True
+            else:
+                building = False
+
+        if not building:
+            return future.result()
+
+        try:
+            value = factory()
+        except BaseException as e:
+            with self._lock:
+                self._building.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self.put(key, value)
+            self._building.pop(key, None)
+        future.set_result(value)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_MISSING = object()
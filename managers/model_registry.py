@@ -0,0 +1,280 @@
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import Future, TimeoutError
+
+import streamlit as st
+from langchain_core.runnables import Runnable
+from langchain_openai import ChatOpenAI
+from langchain_anthropic import ChatAnthropic
+
+# prices are USD per million tokens
+MODELS = {
+    "gpt-4o-2024-08-06": {
+        "provider": "openai",
+        "context_window": 128000,
+        "max_output_tokens": 16384,
+        "streaming_usage": True,
+        "pricing": {"input": 2.5, "output": 10, "cache_read": 1.25},
+    },
+    "gpt-4o": {
+        "provider": "openai",
+        "context_window": 128000,
+        "max_output_tokens": 16384,
+        "streaming_usage": True,
+        "pricing": {"input": 2.5, "output": 10, "cache_read": 1.25},
+    },
+    "gpt-4o-mini": {
+        "provider": "openai",
+        "context_window": 128000,
+        "max_output_tokens": 16384,
+        "streaming_usage": True,
+        "pricing": {"input": 0.15, "output": 0.6, "cache_read": 0.075},
+    },
+    "claude-3-5-sonnet-20241022": {
+        "provider": "anthropic",
+        "context_window": 200000,
+        "max_output_tokens": 8192,
+        "streaming_usage": True,
+        "pricing": {"input": 3, "output": 15, "cache_read": 0.3, "cache_write": 3.75},
+    },
+    "claude-3-7-sonnet-20250219": {
+        "provider": "anthropic",
+        "context_window": 200000,
+        "max_output_tokens": 8192,
+        "streaming_usage": True,
+        "pricing": {"input": 3, "output": 15, "cache_read": 0.3, "cache_write": 3.75},
+    },
+    "claude-3-5-haiku-20241022": {
+        "provider": "anthropic",
+        "context_window": 200000,
+        "max_output_tokens": 8192,
+        "streaming_usage": True,
+        "pricing": {"input": 0.8, "output": 4, "cache_read": 0.08, "cache_write": 1},
+    },
+    "claude-3-opus-20240229": {
+        "provider": "anthropic",
+        "context_window": 200000,
+        "max_output_tokens": 4096,
+        "streaming_usage": True,
+        "pricing": {"input": 15, "output": 75, "cache_read": 1.5, "cache_write": 18.75},
+    },
+    "text-embedding-3-small": {
+        "provider": "openai",
+        "context_window": 8191,
+        "max_output_tokens": 0,
+        "streaming_usage": False,
+        "pricing": {"input": 0.02, "output": 0},
+    },
+}
+
+
+class ModelRegistry:
+    """One entry per model: provider, limits, pricing and streaming-usage support.
+
+    Entries in `[models."<model id>"]` of the secrets extend or override the
+    built-in table, e.g. to add a model or set its `fallback` model.
+    """
+
+    @staticmethod
+    def get_spec(model_id):
+        spec = dict(MODELS.get(model_id, {}))
+        overrides = st.secrets.get("models", {}).get(model_id, {})
+        spec.update(overrides)
+        if "pricing" in overrides:
+            spec["pricing"] = {**MODELS.get(model_id, {}).get("pricing", {}), **overrides["pricing"]}
+
+        if "provider" not in spec:
+            raise ValueError(f"Unknown model: {model_id}")
+        return spec
+
+    @staticmethod
+    def get_chat_model(model_id, temperature=0, max_tokens=None):
+        """Chat client for `model_id`, shared per (model, temperature, max_tokens).
+
+        The chat page's temperature slider has 0.01 steps, so the temperature
+        is rounded to that step and the client cache is bounded.
+        """
+        return ModelRegistry._build_chat_model(model_id, round(float(temperature), 2), max_tokens)
+
+    @staticmethod
+    @st.cache_resource(max_entries=64)
+    def _build_chat_model(model_id, temperature, max_tokens):
+        spec = ModelRegistry.get_spec(model_id)
+        max_tokens = max_tokens or spec["max_output_tokens"]
+
+        if spec["provider"] == "openai":
+            return ChatOpenAI(
+                model=model_id,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                model_kwargs=(
+                    {"stream_options": {"include_usage": True}}
+                    if spec["streaming_usage"] else {}
+                ),
+                api_key=st.secrets['OPENAI_API_KEY'],
+            )
+        if spec["provider"] == "anthropic":
+            return ChatAnthropic(
+                model=model_id,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream_usage=spec["streaming_usage"],
+                api_key=st.secrets['ANTHROPIC_API_KEY']
+            )
+        raise ValueError(f"Unsupported provider for {model_id}: {spec['provider']}")
+
+    @staticmethod
+    def get_answer_model(model_id, temperature=0):
+        """Chat model for answers, failing over to the configured fallback model
+        when the first token does not arrive within `[rag] ttft_deadline` seconds.
+        """
+        llm = ModelRegistry.get_chat_model(model_id, temperature)
+        fallback_id = ModelRegistry.get_spec(model_id).get("fallback")
+        if not fallback_id:
+            return llm
+
+        return DeadlineFallback(
+            llm,
+            ModelRegistry.get_chat_model(fallback_id, temperature),
+            deadline=st.secrets.get("rag", {}).get("ttft_deadline", 10),
+            primary_format=ModelRegistry.get_input_format(model_id),
+            fallback_format=ModelRegistry.get_input_format(fallback_id)
+        )
+
+    @staticmethod
+    def get_input_format(model_id):
+        """Step preparing chat messages for the model, or None if they pass as is.
+
+        Only Anthropic accepts `cache_control` breakpoints, so other
+        providers get the messages without them.
+        """
+        if ModelRegistry.get_spec(model_id)["provider"] == "anthropic":
+            return None
+        return strip_cache_control
+
+
+def strip_cache_control(input):
+    """Chat messages without Anthropic `cache_control` breakpoints."""
+    if not isinstance(input, list):
+        # prompt values come straight from a template and carry no breakpoints
+        return input
+
+    messages = []
+    for message in input:
+        if isinstance(message.content, list):
+            message = message.model_copy(update={"content": [
+                {key: value for key, value in block.items() if key != "cache_control"}
+                if isinstance(block, dict) else block
+                for block in message.content
+            ]})
+        messages.append(message)
+    return messages
+
+
+class DeadlineFallback(Runnable):
+    """Stream from `primary`, switching to `fallback` if it errors or stalls
+    before its first chunk. Once a chunk has been emitted there is no failover.
+
+    `primary_format` and `fallback_format` prepare the input for each model,
+    so provider-specific markup such as prompt cache breakpoints only reaches
+    the model that accepts it.
+    """
+
+    def __init__(self, primary, fallback, deadline, primary_format=None, fallback_format=None):
+        self.primary = primary
+        self.fallback = fallback
+        self.deadline = deadline
+        self.primary_format = primary_format
+        self.fallback_format = fallback_format
+
+    def invoke(self, input, config=None, **kwargs):
+        output = None
+        for chunk in self.stream(input, config, **kwargs):
+            output = chunk if output is None else output + chunk
+        return output
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        output = None
+        async for chunk in self.astream(input, config, **kwargs):
+            output = chunk if output is None else output + chunk
+        return output
+
+    def stream(self, input, config=None, **kwargs):
+        primary_input, fallback_input = self._inputs(input)
+        iterator = self.primary.stream(primary_input, config, **kwargs)
+        future = DeadlineFallback._first_chunk(iterator)
+        try:
+            first = future.result(timeout=self.deadline)
+        except TimeoutError:
+            print(f"No first token within {self.deadline}s, falling back to {self._name(self.fallback)}")
+            # the stalled `next` still owns the generator; close it, and with
+            # it the primary's connection, as soon as that call returns
+            future.add_done_callback(lambda _: iterator.close())
+            yield from self.fallback.stream(fallback_input, config, **kwargs)
+            return
+        except Exception as e:
+            print(f"Primary model failed, falling back to {self._name(self.fallback)}:", str(e))
+            iterator.close()
+            yield from self.fallback.stream(fallback_input, config, **kwargs)
+            return
+
+        if first is not None:
+            yield first
+        yield from iterator
+
+    async def astream(self, input, config=None, **kwargs):
+        primary_input, fallback_input = self._inputs(input)
+        iterator = self.primary.astream(primary_input, config, **kwargs)
+        try:
+            first = await asyncio.wait_for(anext(iterator, None), self.deadline)
+        except asyncio.TimeoutError:
+            print(f"No first token within {self.deadline}s, falling back to {self._name(self.fallback)}")
+            # wait_for cancelled the pending request; release the generator too
+            await iterator.aclose()
+            async for chunk in self.fallback.astream(fallback_input, config, **kwargs):
+                yield chunk
+            return
+        except Exception as e:
+            print(f"Primary model failed, falling back to {self._name(self.fallback)}:", str(e))
+            await iterator.aclose()
+            async for chunk in self.fallback.astream(fallback_input, config, **kwargs):
+                yield chunk
+            return
+
+        if first is not None:
+            yield first
+        async for chunk in iterator:
+            yield chunk
+
+    def _inputs(self, input):
+        return (
+            self.primary_format(input) if self.primary_format else input,
+            self.fallback_format(input) if self.fallback_format else input,
+        )
+
+    @staticmethod
+    def _first_chunk(iterator):
+        """Start reading the first chunk on its own thread, so the deadline
+        runs from the request rather than from a free slot in a shared pool."""
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def read():
+            try:
+                future.set_result(next(iterator, None))
+            except BaseException as e:
+                future.set_exception(e)
+
+        # the first chunk starts the run, so it must see the caller's callbacks
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(read,),
+            name="ttft-deadline",
+            daemon=True
+        ).start()
+        return future
+
+    @staticmethod
+    def _name(model):
+        return getattr(model, "model_name", None) or getattr(model, "model", "fallback model")
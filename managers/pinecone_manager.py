@@ -1,15 +1,20 @@
-import hashlib
-import requests
+import uuid
 import streamlit as st
 from stqdm import stqdm
 from pinecone import Pinecone, ServerlessSpec
 
-from .llm_manager import LLMManger
+from .lexical_index import LexicalIndex
+from .vector_store import LocalVectorIndex
+from .text_utils import content_hash
+from .tracer import http
 
 
 class PineconeManager:
     @staticmethod
     def get_index():
+        if st.secrets.get("vector_store", {}).get("backend", "pinecone") == "local":
+            return LocalVectorIndex.get_shared()
+
         pc = Pinecone(api_key=st.secrets["PINECONE_API_KEY"])
         index_name = st.secrets["INDEX_NAME"]
         spec = ServerlessSpec(
@@ -38,73 +43,161 @@ class PineconeManager:
         return index
 
     @staticmethod
-    def delete_pinecone_documents(selected_document_ids):
+    def get_vector_ids(document_id):
+        """Get the vector ids of a document from the backend, or None on failure."""
         headers = {
             "Authorization": f"Bearer {st.session_state.token}"
         }
-        for document_id in selected_document_ids:
-            # get vector ids of the document from database   
-            response = requests.get(
-                f"{st.secrets.BACKEND_URL}/vectors",
-                params={"document_id": document_id},
-                headers=headers
-            )
-            if response.status_code == 200:
-                vector_ids = response.json()["vectors"]
+        response = http.get(
+            f"{st.secrets.BACKEND_URL}/vectors",
+            params={"document_id": document_id},
+            headers=headers
+        )
+        if response.status_code != 200:
+            return None
+        return response.json()["vectors"]
 
-                # delete pincecone vectors in batches
-                for i in range(0, len(vector_ids), 1000):
-                    batch_ids = vector_ids[i: i + 1000]
-                    st.session_state.index.delete(ids=batch_ids)
+    @staticmethod
+    def tag_namespace(tag, username=None):
+        """Namespace of a user's tag, by default of the user of this session.
 
-            else:
+        Tags belong to a user, so a namespace only holds one user's documents
+        and a question over the whole tag needs no title filter.
+        """
+        return f"{username or st.session_state.username}/{tag}"
+
+    @staticmethod
+    def delete_pinecone_documents(selected_document_ids, tags):
+        """Delete the vectors of documents from their tag namespaces."""
+        for document_id, tag in zip(selected_document_ids, tags):
+            # get vector ids of the document from database
+            vector_ids = PineconeManager.get_vector_ids(document_id)
+            if vector_ids is None:
                 st.error("無法刪除 Pinecone 向量！")
                 return
 
+            # delete pincecone vectors in batches
+            PineconeManager.delete_batch(
+                st.session_state.index,
+                vector_ids,
+                PineconeManager.tag_namespace(tag)
+            )
+
     @staticmethod
-    def generate_unique_id(content: str) -> str:
-        # Ensure the content is encoded to bytes
-        content_bytes = content.encode("utf-8", errors="ignore")
-        # Create a SHA-256 hash object
-        sha256_hash = hashlib.sha256()
-        # Update the hash object with the bytes of the content
-        sha256_hash.update(content_bytes)
-        # Get the hexadecimal representation of the hash
-        unique_id = sha256_hash.hexdigest()
-        return unique_id
+    def move_vectors(vector_ids, source_namespace, target_namespace, tag, batch_size=200):
+        """Move vectors (and their lexical postings) between namespaces,
+        updating their "tag" metadata."""
+        for i in range(0, len(vector_ids), batch_size):
+            batch_ids = vector_ids[i: i + batch_size]
+            vectors = st.session_state.index.fetch(
+                batch_ids, namespace=source_namespace)["vectors"]
+            if not vectors:
+                continue
+
+            to_upsert = []
+            for vector_id, vector in vectors.items():
+                metadata = dict(vector["metadata"])
+                metadata["tag"] = tag
+                to_upsert.append((vector_id, vector["values"], metadata))
+
+            st.session_state.index.upsert(
+                vectors=to_upsert, namespace=target_namespace)
+            st.session_state.index.delete(
+                ids=list(vectors), namespace=source_namespace)
+            if LexicalIndex.is_enabled():
+                LexicalIndex.get_shared().move(list(vectors), target_namespace, tag)
+
+    @staticmethod
+    def rename_tag_namespace(current_tag, new_tag):
+        """Move the documents of a renamed tag into the new tag's namespace."""
+        document_ids = st.session_state.documents[
+            st.session_state.documents["tag"] == current_tag
+        ]["id"].tolist()
+
+        for document_id in document_ids:
+            vector_ids = PineconeManager.get_vector_ids(document_id)
+            if vector_ids is None:
+                return False
+            PineconeManager.move_vectors(
+                vector_ids,
+                PineconeManager.tag_namespace(current_tag),
+                PineconeManager.tag_namespace(new_tag),
+                new_tag
+            )
+        return True
 
     @staticmethod
-    def upsert_documents(documents, desc, batch_size=64):
-        llm_manager = LLMManger()
-        id_list = []
-        total_price = 0
-
-        for i in stqdm(range(0, len(documents), batch_size), desc=desc):
-            docs = documents[i: i + batch_size]
-            contents = [doc["content"] for doc in docs]
-            embeddings, price = llm_manager.get_embeddings(contents)
-
-            if embeddings is None:
-                doc_name = docs[0]["name"]
-                print(f"cannot encode {doc_name} page {i}-{i + batch_size}")
+    @st.cache_resource
+    def _migrated_users():
+        """Users whose legacy vectors were already checked by this process."""
+        return set()
+
+    @staticmethod
+    def migrate_legacy_namespaces():
+        """Move the user's vectors out of the namespaces shared by all users.
+
+        Vectors used to be stored in the default namespace, and then in one
+        namespace per tag name. Runs when a session starts, once per user and
+        process, and only while one of these namespaces still holds vectors.
+        """
+        username = st.session_state.username
+        if username in PineconeManager._migrated_users():
+            return
+
+        stats = st.session_state.index.describe_index_stats()
+        legacy = {
+            namespace for namespace, summary in stats["namespaces"].items()
+            if summary["vector_count"] > 0
+        }
+        documents = st.session_state.documents
+        for document_id, tag in zip(documents["id"], documents["tag"]):
+            sources = [namespace for namespace in ("", tag) if namespace in legacy]
+            if not sources:
                 continue
 
-            total_price += price
-            ids_batch = [
-                PineconeManager.generate_unique_id(doc["content"])
-                for doc in docs
-            ]
-            to_upsert = list(zip(ids_batch, embeddings, docs))
-            st.session_state.index.upsert(vectors=to_upsert)
-            id_list += ids_batch
+            vector_ids = PineconeManager.get_vector_ids(document_id)
+            if vector_ids is None:
+                # try again in the next session
+                print(f"Cannot get vectors of document {document_id}")
+                return
+            for source in sources:
+                PineconeManager.move_vectors(
+                    vector_ids, source, PineconeManager.tag_namespace(tag), tag)
+
+        PineconeManager._migrated_users().add(username)
 
-        return id_list, total_price
+    @staticmethod
+    def generate_unique_id(document_key: str, content: str) -> str:
+        # per document, so documents sharing a page each keep their own
+        # metadata and deleting one leaves the other's pages intact
+        return f"{document_key}#{content_hash(content)}"
+
+    @staticmethod
+    def new_document_key() -> str:
+        """Key of a newly uploaded document, shared by its vector ids."""
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def upsert_batch(index, ids, docs, embeddings, namespace):
+        """Upsert embedded page records (and their lexical postings) under `ids`."""
+        index.upsert(vectors=list(zip(ids, embeddings, docs)), namespace=namespace)
+        if LexicalIndex.is_enabled():
+            LexicalIndex.get_shared().add_documents(ids, docs, namespace)
+
+    @staticmethod
+    def delete_batch(index, ids, namespace, batch_size=1000):
+        """Delete vectors (and their lexical postings) from a namespace."""
+        for i in range(0, len(ids), batch_size):
+            batch_ids = ids[i: i + batch_size]
+            index.delete(ids=batch_ids, namespace=namespace)
+            if LexicalIndex.is_enabled():
+                LexicalIndex.get_shared().delete(batch_ids)
 
     @staticmethod
-    def fetch_document_content(vector_list):
+    def fetch_document_content(vector_list, namespace=None):
         content = ""
         try:
-            vectors = st.session_state.index.fetch(vector_list)
+            vectors = st.session_state.index.fetch(vector_list, namespace=namespace)
             metadata = [
                 vector["metadata"]
                 for _id, vector in vectors["vectors"].items()
@@ -0,0 +1,126 @@
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+from langchain import hub
+from langchain_core.load import dumpd, load
+
+from .tracer import span
+
+
+class PromptManager:
+    """Serve LangChain hub prompts from memory without touching the network.
+
+    Prompts are read from an on-disk snapshot at start-up and fall back to the
+    bundled templates when no snapshot exists yet. A daemon thread re-pulls
+    every prompt from the hub on a fixed interval and rewrites the snapshot,
+    so a slow or unreachable hub never blocks a chat turn.
+    """
+
+    def __init__(self, fallbacks, api_key, snapshot_path, refresh_interval=600):
+        self.fallbacks = fallbacks
+        self.api_key = api_key
+        self.snapshot_path = Path(snapshot_path)
+        self.refresh_interval = refresh_interval
+        self._prompts = {}
+        self._versions = {}
+        # hashes of the bundled templates, served until a snapshot or pull replaces them
+        self._fallback_versions = {
+            name: PromptManager._hash(dumpd(prompt)) for name, prompt in fallbacks.items()
+        }
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._load_snapshot()
+
+    def start(self):
+        """Start the background refresh thread (idempotent)."""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._refresh_loop, name="prompt-refresh", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def get(self, name):
+        with self._lock:
+            if name in self._prompts:
+                return self._prompts[name]
+        return self.fallbacks[name]
+
+    def version(self, name):
+        """Content hash of the prompt currently served for `name`."""
+        with self._lock:
+            if name in self._versions:
+                return self._versions[name]
+        return self._fallback_versions[name]
+
+    def refresh(self):
+        """Pull every prompt from the hub and persist the snapshot."""
+        updated = False
+        for name in self.fallbacks:
+            try:
+                with span("hub.pull", prompt=name):
+                    prompt = hub.pull(name, api_key=self.api_key)
+            except Exception as e:
+                print(f"Cannot pull prompt {name}:", str(e))
+                continue
+
+            serialized = dumpd(prompt)
+            version = PromptManager._hash(serialized)
+            with self._lock:
+                if self._versions.get(name) != version:
+                    self._prompts[name] = prompt
+                    self._versions[name] = version
+                    updated = True
+
+        if updated:
+            self._save_snapshot()
+        return updated
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.refresh_interval)
+
+    def _load_snapshot(self):
+        if not self.snapshot_path.exists():
+            return
+
+        try:
+            snapshot = json.loads(self.snapshot_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            print("Cannot read prompt snapshot:", str(e))
+            return
+
+        for name, serialized in snapshot.items():
+            if name not in self.fallbacks:
+                continue
+            try:
+                self._prompts[name] = load(serialized)
+                self._versions[name] = PromptManager._hash(serialized)
+            except Exception as e:
+                print(f"Cannot load prompt {name} from snapshot:", str(e))
+
+    def _save_snapshot(self):
+        with self._lock:
+            snapshot = {
+                name: dumpd(prompt) for name, prompt in self._prompts.items()
+            }
+
+        # write to a temporary file first so readers never see a partial snapshot
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        tmp_path.write_text(
+            json.dumps(snapshot, ensure_ascii=False), encoding="utf-8")
+        tmp_path.replace(self.snapshot_path)
+
+    @staticmethod
+    def _hash(serialized):
+        payload = json.dumps(serialized, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12]
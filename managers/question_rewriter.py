@@ -0,0 +1,139 @@
+import re
+import hashlib
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+from .embedding_manager import EmbeddingCache
+from .text_utils import lexical_terms
+
+# words that point back at earlier turns ("it", "that agency", "what about...")
+REFERENCE_PATTERN = re.compile(
+    r"[它他她其此該這那]|上述|前面|剛才|剛剛|以上|同樣|另外|還有|呢[?？]?$"
+    r"|\b(it|its|they|them|their|this|that|these|those|above|previous|earlier|same|also)\b",
+    re.IGNORECASE
+)
+
+# a subject the question names itself: a quoted title, a year or amount, or
+# the name of an organization or regulation
+SUBJECT_PATTERN = re.compile(
+    r"「[^」]+」|《[^》]+》|\"[^\"]+\"|\d{2,}"
+    r"|[\u4e00-\u9fff]{2,}(?:條例|辦法|計畫|方案|政策|公司|大學|政府|銀行|協會|基金會|委員會|部會|機關)"
+)
+
+# capitalized words, which may be proper nouns or acronyms
+CAPITALIZED_PATTERN = re.compile(r"\b[A-Z][A-Za-z0-9]+\b")
+
+# text before a word that starts a sentence, where any word is capitalized
+SENTENCE_START_PATTERN = re.compile(r"(?:^|[.!?。？！])[\s\"'(（「]*$")
+
+QUESTION_WORDS = {
+    "how", "what", "when", "where", "which", "who", "whom", "whose", "why",
+    "is", "are", "was", "were", "do", "does", "did", "can", "could", "will",
+    "would", "should", "may", "might", "has", "have", "had",
+}
+
+
+def names_subject(question):
+    """Whether the question names its own subject.
+
+    A capitalized word counts when it is an acronym or a mixed-case name, or
+    when it does not start a sentence; question words never count, so
+    "How often?" has no subject of its own.
+    """
+    if SUBJECT_PATTERN.search(question):
+        return True
+    for match in CAPITALIZED_PATTERN.finditer(question):
+        word = match.group()
+        if word.lower() in QUESTION_WORDS:
+            continue
+        if any(char.isupper() or char.isdigit() for char in word[1:]):
+            return True
+        if not SENTENCE_START_PATTERN.search(question[:match.start()]):
+            return True
+    return False
+
+
+class QuestionRewriter:
+    """Rewrite follow-up questions into standalone ones with a small model.
+
+    Questions that reference nothing earlier are passed through untouched,
+    only the last `max_turns` turns are sent to the model, and rewrites are
+    cached by (those turns, question).
+    """
+
+    def __init__(self, llm, prompt, max_turns=2, min_length=8, cache=None, version=""):
+        self.chain = prompt | llm | StrOutputParser()
+        self.max_turns = max_turns
+        self.min_length = min_length
+        self.cache = cache
+        self.version = version
+
+    def as_runnable(self):
+        return RunnableLambda(self.invoke, afunc=self.ainvoke, name="question_rewriter")
+
+    def is_self_contained(self, question, chat_history=()):
+        """Cheap check that the question needs no earlier turn to be understood.
+
+        Without history every question stands alone. After it, a question
+        must be long enough, point back at nothing, name its own subject and
+        share no terms with the previous question, which would mean it
+        continues that topic (e.g. "多久要進行一次？" after a question about
+        an agency has no subject of its own).
+        """
+        question = question.strip()
+        if not chat_history:
+            return True
+        if len(question) < self.min_length or REFERENCE_PATTERN.search(question):
+            return False
+        if not names_subject(question):
+            return False
+
+        previous = next(
+            (message.content for message in reversed(chat_history) if message.type == "human"),
+            ""
+        )
+        return not set(lexical_terms(question)) & set(lexical_terms(previous))
+
+    def invoke(self, x, config):
+        if self._skip(x):
+            return x["input"]
+
+        key = self._key(x)
+        if self.cache is not None and (question := self.cache.get(key)) is not None:
+            return question
+
+        question = self.chain.invoke(self._recent(x), config)
+        if self.cache is not None:
+            self.cache.put(key, question)
+        return question
+
+    async def ainvoke(self, x, config):
+        if self._skip(x):
+            return x["input"]
+
+        key = self._key(x)
+        if self.cache is not None and (question := self.cache.get(key)) is not None:
+            return question
+
+        question = await self.chain.ainvoke(self._recent(x), config)
+        if self.cache is not None:
+            self.cache.put(key, question)
+        return question
+
+    def _skip(self, x):
+        return self.is_self_contained(x["input"], x.get("chat_history"))
+
+    def _recent(self, x):
+        return {
+            "input": x["input"],
+            "chat_history": x["chat_history"][-2 * self.max_turns:],
+        }
+
+    def _key(self, x):
+        digest = hashlib.sha256(self.version.encode("utf-8"))
+        for message in x["chat_history"][-2 * self.max_turns:]:
+            digest.update(f"\0{message.type}\0{message.content}".encode("utf-8"))
+        digest.update(b"\0" + EmbeddingCache.normalize(x["input"]).encode("utf-8"))
+        return digest.hexdigest()
+
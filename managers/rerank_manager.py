@@ -0,0 +1,115 @@
+import math
+import time
+import functools
+from collections import Counter
+
+from .text_utils import lexical_terms
+
+# standard Okapi BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+@functools.lru_cache(maxsize=2048)
+def term_counts(content):
+    """Lexical term frequencies of a page (memoized, pages recur across turns)."""
+    return Counter(lexical_terms(content))
+
+
+@functools.lru_cache(maxsize=2)
+def load_cross_encoder(model_name):
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError:
+        print("sentence-transformers is not installed, reranking with BM25 only")
+        return None
+    return CrossEncoder(model_name, device="cpu")
+
+
+def bm25_scores(query_terms, documents_terms):
+    """Score each document's term counts against the query with BM25.
+
+    IDF is computed over the given documents, which is what a reranker wants:
+    terms shared by every candidate carry no information.
+    """
+    n = len(documents_terms)
+    if n == 0:
+        return []
+
+    lengths = [sum(counts.values()) for counts in documents_terms]
+    avg_length = (sum(lengths) / n) or 1
+    scores = [0.0] * n
+    for term in set(query_terms):
+        df = sum(1 for counts in documents_terms if term in counts)
+        if df == 0:
+            continue
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for i, counts in enumerate(documents_terms):
+            tf = counts.get(term)
+            if tf:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[i] / avg_length)
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return scores
+
+
+class Reranker:
+    """Rescore over-fetched vector hits on the CPU and keep the best `top_n`.
+
+    The lexical score is BM25 over CJK bigrams, or a cross-encoder when one is
+    configured. It is blended with the dense retrieval rank through
+    `lexical_weight`. Cross-encoder batches stop once `latency_budget_ms` is
+    spent; unscored candidates fall back to BM25.
+    """
+
+    def __init__(
+        self,
+        top_n=10,
+        lexical_weight=0.5,
+        cross_encoder=None,
+        batch_size=16,
+        latency_budget_ms=300
+    ):
+        self.top_n = top_n
+        self.lexical_weight = lexical_weight
+        self.cross_encoder = cross_encoder
+        self.batch_size = batch_size
+        self.latency_budget_ms = latency_budget_ms
+
+    def rerank(self, query, docs):
+        if not docs:
+            return docs
+
+        started_at = time.perf_counter()
+        lexical = bm25_scores(
+            lexical_terms(query), [term_counts(doc.page_content) for doc in docs])
+        lexical = Reranker._min_max(lexical)
+
+        model = load_cross_encoder(self.cross_encoder) if self.cross_encoder else None
+        if model is not None:
+            for start in range(0, len(docs), self.batch_size):
+                elapsed_ms = (time.perf_counter() - started_at) * 1000
+                if elapsed_ms > self.latency_budget_ms:
+                    break
+                batch = docs[start: start + self.batch_size]
+                logits = model.predict([(query, doc.page_content) for doc in batch])
+                for i, logit in enumerate(logits, start=start):
+                    lexical[i] = 1 / (1 + math.exp(-float(logit)))
+
+        # docs arrive in vector-score order, so the rank is the dense signal
+        n = len(docs)
+        for rank, doc in enumerate(docs):
+            dense = 1 - rank / n
+            doc.metadata["score"] = (
+                self.lexical_weight * lexical[rank]
+                + (1 - self.lexical_weight) * dense
+            )
+
+        ranked = sorted(docs, key=lambda doc: -doc.metadata["score"])
+        return ranked[:self.top_n]
+
+    @staticmethod
+    def _min_max(scores):
+        low, high = min(scores), max(scores)
+        if high == low:
+            return [0.0] * len(scores)
+        return [(score - low) / (high - low) for score in scores]
@@ -1,9 +1,9 @@
 import streamlit as st
 import pandas as pd
-import requests
 from pinecone import Pinecone, ServerlessSpec
 
 from .pinecone_manager import PineconeManager
+from .tracer import http
 
 
 class SessionManager:
@@ -62,7 +62,7 @@ class SessionManager:
             "Authorization": f"Bearer {st.session_state.token}"
         }
         api_url = f"{st.secrets.BACKEND_URL}/documents"
-        response = requests.get(api_url, headers=headers)
+        response = http.get(api_url, headers=headers)
         if response.status_code == 200:
             documents = response.json()["documents"]
             documents = pd.DataFrame(documents, columns=[
@@ -91,7 +91,7 @@ class SessionManager:
 
         if username == st.secrets.ADMIN_NAME:
             if "tokens" not in st.session_state:
-                response = requests.get(
+                response = http.get(
                     f"{st.secrets.BACKEND_URL}/users",
                     headers=headers
                 )
@@ -110,7 +110,7 @@ class SessionManager:
 
         if "tags" not in st.session_state:
             api_url = f"{st.secrets.BACKEND_URL}/tags"
-            response = requests.get(api_url, headers=headers)
+            response = http.get(api_url, headers=headers)
             
             if response.status_code == 200:
                 if len(response.json()["tags"]) != 0:
@@ -121,7 +121,7 @@ class SessionManager:
                 st.error("無法讀取標籤")
 
         if "cost" not in st.session_state:
-            response = requests.get(
+            response = http.get(
                 f"{st.secrets.BACKEND_URL}/cost",
                 headers=headers
             )
@@ -133,7 +133,7 @@ class SessionManager:
         # Initialize chat history
         if "messages" not in st.session_state:
             api_url = f"{st.secrets.BACKEND_URL}/messages"
-            response = requests.get(api_url, headers=headers)
+            response = http.get(api_url, headers=headers)
 
             if response.status_code == 200:
                 messages = pd.DataFrame(response.json()["messages"], columns=[
@@ -157,6 +157,8 @@ class SessionManager:
 
         if "index" not in st.session_state:
             st.session_state.index = PineconeManager.get_index()
+            if st.session_state.get("documents") is not None:
+                PineconeManager.migrate_legacy_namespaces()
 
 
     @staticmethod
@@ -0,0 +1,122 @@
+import time
+import asyncio
+
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables.config import get_executor_for_config
+
+from .lexical_index import reciprocal_rank_fusion
+
+
+class SpeculativeRetriever:
+    """History-aware retrieval that does not wait for the question rewrite.
+
+    On follow-up turns the raw question is retrieved while the rewriter runs.
+    If the rewritten question embeds within `threshold` cosine similarity of
+    the raw one, the speculative hits are used as they are; otherwise the
+    rewritten question is retrieved too and both lists are fused (RRF).
+    Per-path latencies of each turn are kept in `stats`, keyed by session.
+    """
+
+    def __init__(self, retriever, rewriter, embeddings, threshold=0.9, stats=None):
+        self.retriever = retriever
+        self.rewriter = rewriter
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.stats = stats
+
+    def as_runnable(self):
+        return RunnableLambda(
+            self.invoke, afunc=self.ainvoke, name="speculative_retriever")
+
+    def invoke(self, x, config):
+        if not x.get("chat_history"):
+            return self.retriever.invoke(x["input"], config)
+
+        started_at = time.perf_counter()
+        with get_executor_for_config(config) as executor:
+            speculative = executor.submit(
+                SpeculativeRetriever._timed, self.retriever.invoke, x["input"], config)
+            rewrite = executor.submit(
+                SpeculativeRetriever._timed, self.rewriter.invoke, x, config)
+            (docs, speculative_ms), (question, rewrite_ms) = (
+                speculative.result(), rewrite.result())
+
+        similarity = SpeculativeRetriever._cosine(
+            self.embeddings.embed_query(x["input"]),
+            self.embeddings.embed_query(question)
+        )
+        followup_ms = None
+        if similarity < self.threshold:
+            followup_docs, followup_ms = SpeculativeRetriever._timed(
+                self.retriever.invoke, question, config)
+            docs = self._merge(followup_docs, docs)
+
+        self._record(config, started_at, speculative_ms, rewrite_ms, followup_ms, similarity)
+        return docs
+
+    async def ainvoke(self, x, config):
+        if not x.get("chat_history"):
+            return await self.retriever.ainvoke(x["input"], config)
+
+        started_at = time.perf_counter()
+        (docs, speculative_ms), (question, rewrite_ms) = await asyncio.gather(
+            SpeculativeRetriever._atimed(self.retriever.ainvoke(x["input"], config)),
+            SpeculativeRetriever._atimed(self.rewriter.ainvoke(x, config)),
+        )
+
+        input_embedding, question_embedding = await asyncio.gather(
+            self.embeddings.aembed_query(x["input"]),
+            self.embeddings.aembed_query(question)
+        )
+        similarity = SpeculativeRetriever._cosine(input_embedding, question_embedding)
+        followup_ms = None
+        if similarity < self.threshold:
+            followup_docs, followup_ms = await SpeculativeRetriever._atimed(
+                self.retriever.ainvoke(question, config))
+            docs = self._merge(followup_docs, docs)
+
+        self._record(config, started_at, speculative_ms, rewrite_ms, followup_ms, similarity)
+        return docs
+
+    def _merge(self, followup_docs, speculative_docs):
+        # the rewritten question is the better query, so its hits rank first
+        k = max(len(followup_docs), len(speculative_docs))
+        return reciprocal_rank_fusion([followup_docs, speculative_docs])[:k]
+
+    def _record(self, config, started_at, speculative_ms, rewrite_ms, followup_ms, similarity):
+        if self.stats is None:
+            return
+
+        total_ms = (time.perf_counter() - started_at) * 1000
+        # what the serial rewrite-then-retrieve chain would have taken
+        serial_ms = rewrite_ms + (followup_ms if followup_ms is not None else speculative_ms)
+        session_id = config.get("configurable", {}).get("session_id")
+        self.stats.put(session_id, {
+            "path": "speculative" if followup_ms is None else "merged",
+            "similarity": similarity,
+            "speculative_ms": speculative_ms,
+            "rewrite_ms": rewrite_ms,
+            "followup_ms": followup_ms,
+            "total_ms": total_ms,
+            "saved_ms": serial_ms - total_ms,
+        })
+
+    @staticmethod
+    def _timed(func, *args):
+        started_at = time.perf_counter()
+        result = func(*args)
+        return result, (time.perf_counter() - started_at) * 1000
+
+    @staticmethod
+    async def _atimed(coroutine):
+        started_at = time.perf_counter()
+        result = await coroutine
+        return result, (time.perf_counter() - started_at) * 1000
+
+    @staticmethod
+    def _cosine(a, b):
+        a = np.asarray(a, dtype=np.float32)
+        b = np.asarray(b, dtype=np.float32)
+        norm = np.linalg.norm(a) * np.linalg.norm(b)
+        return float(np.dot(a, b) / norm) if norm else 0.0
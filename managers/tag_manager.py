@@ -1,7 +1,8 @@
-import requests
 import streamlit as st
 from streamlit_tags import st_tags
+from .pinecone_manager import PineconeManager
 from .session_manager import SessionManager
+from .tracer import http
 
 
 class TagManager:
@@ -10,7 +11,7 @@ class TagManager:
         headers = {
             "Authorization": f"Bearer {st.session_state.token}"
         }
-        response = requests.post(
+        response = http.post(
             f"{st.secrets.BACKEND_URL}/tags",
             json={
                 "username": st.session_state.username,
@@ -66,7 +67,7 @@ class TagManager:
         }
 
         for tag_id in tag_ids:   
-            response = requests.delete(
+            response = http.delete(
                 f"{st.secrets.BACKEND_URL}/tags/{tag_id}",
                 headers=headers
             )
@@ -101,7 +102,7 @@ class TagManager:
                 headers = {
                     "Authorization": f"Bearer {st.session_state.token}"
                 }
-                response = requests.put(
+                response = http.put(
                     f"{st.secrets.BACKEND_URL}/tags/{tag_id}",
                     json={"new_tag": new_tag},
                     headers=headers
@@ -110,6 +111,11 @@ class TagManager:
                     st.error("修改標籤失敗！")
                     return
 
+                # vectors are partitioned by tag, so move them to the new namespace
+                if not PineconeManager.rename_tag_namespace(current_tag, new_tag):
+                    st.error("無法搬移 Pinecone 向量！")
+                    return
+
                 st.session_state.documents["tag"] = st.session_state.documents["tag"].replace(
                     current_tag, new_tag
                 )
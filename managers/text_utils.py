@@ -0,0 +1,67 @@
+import re
+import hashlib
+import functools
+import unicodedata
+
+import tiktoken
+
+# CJK ideographs (incl. extension A and compatibility ideographs) or ASCII words
+TERM_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+")
+
+
+CJK_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+
+@functools.lru_cache(maxsize=1)
+def get_encoding():
+    # o200k_base is the gpt-4o tokenizer; it is a close enough estimate for Claude
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # the BPE file is downloaded on first use, which fails on offline hosts
+        print("Cannot load tiktoken encoding, estimating token counts:", str(e))
+        return None
+
+
+@functools.lru_cache(maxsize=8)
+def get_model_encoding(model):
+    """The tokenizer of an OpenAI model (cl100k_base for the embedding models), or None."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        print(f"Cannot load tiktoken encoding of {model}, estimating token counts:", str(e))
+        return None
+
+
+@functools.lru_cache(maxsize=8192)
+def count_tokens(text):
+    """Count tokens with the local tiktoken encoder (memoized per text)."""
+    encoding = get_encoding()
+    if encoding is None:
+        # roughly one token per CJK character and per four other characters
+        cjk_chars = len(CJK_PATTERN.findall(text))
+        return cjk_chars + (len(text) - cjk_chars + 3) // 4
+    return len(encoding.encode_ordinary(text))
+
+
+def content_hash(text):
+    """SHA-256 of the raw text: the embedding cache key of a page and part of its vector id."""
+    return hashlib.sha256(text.encode("utf-8", errors="ignore")).hexdigest()
+
+
+def lexical_terms(text):
+    """Split text into lexical terms: character bigrams for CJK, words otherwise.
+
+    Traditional Chinese has no word boundaries, so overlapping bigrams are used
+    as index terms; single-character runs are kept as unigrams.
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    terms = []
+    for run in TERM_PATTERN.findall(text):
+        if run[0].isascii():
+            terms.append(run)
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i: i + 2] for i in range(len(run) - 1))
+    return terms
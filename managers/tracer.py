@@ -0,0 +1,264 @@
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from pathlib import Path
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from urllib.parse import urlsplit
+
+import requests
+import streamlit as st
+from langchain_core.callbacks import BaseCallbackHandler
+
+# the span enclosing the current code; spans opened inside it become children
+current_span_var = ContextVar("current_span", default=None)
+
+# LangChain runnables traced by name, besides retrievers and chat models
+TRACED_RUNS = {
+    "question_rewriter",
+    "speculative_retriever",
+    "hybrid_search",
+    "rerank",
+    "context_pack",
+    "prompt_cache",
+}
+
+
+class Span:
+    """A timed operation; `attributes` carry sizes such as documents or tokens."""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "started_at", "timestamp", "attributes")
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.started_at = time.perf_counter()
+        self.timestamp = time.time()
+        self.attributes = attributes or {}
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """Span-based latency tracing with a rotating JSONL export.
+
+    Finished spans are written by a background listener thread, so the
+    traced code only pays for a dict and a queue put. Durations of the last
+    `window` spans of each name are kept for the p50/p95/p99 summary. A
+    disabled tracer still hands out spans but records nothing.
+    """
+
+    def __init__(self, path, max_bytes=10_000_000, backup_count=5, window=2048, enabled=True):
+        self.enabled = enabled
+        self.window = window
+        self._durations = {}
+        self._lock = threading.Lock()
+        if not enabled:
+            return
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        records = queue.Queue()
+        self._listener = QueueListener(records, handler)
+        self._listener.start()
+
+        self._logger = logging.getLogger(f"tracing.{id(self)}")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        self._logger.addHandler(QueueHandler(records))
+
+    @staticmethod
+    @st.cache_resource
+    def get_shared():
+        """Return the tracer shared by every session of this process."""
+        config = st.secrets.get("tracing", {})
+        return Tracer(
+            config.get("path", ".cache/traces.jsonl"),
+            max_bytes=config.get("max_bytes", 10_000_000),
+            backup_count=config.get("backup_count", 5),
+            window=config.get("window", 2048),
+            enabled=config.get("enabled", True)
+        )
+
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        span = Span(name, parent or current_span_var.get(), attributes)
+        token = current_span_var.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            current_span_var.reset(token)
+            self.finish(span)
+
+    def start(self, name, parent=None, **attributes):
+        """Open a span that is finished explicitly, e.g. across a stream."""
+        return Span(name, parent or current_span_var.get(), attributes)
+
+    def finish(self, span, **attributes):
+        span.set(**attributes)
+        duration_ms = (time.perf_counter() - span.started_at) * 1000
+        self.record(span, duration_ms)
+
+    def record(self, span, duration_ms):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            durations = self._durations.get(span.name)
+            if durations is None:
+                durations = self._durations[span.name] = deque(maxlen=self.window)
+            durations.append(duration_ms)
+
+        try:
+            self._logger.info(json.dumps({
+                "name": span.name,
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "timestamp": span.timestamp,
+                "duration_ms": round(duration_ms, 3),
+                **span.attributes,
+            }, ensure_ascii=False, default=str))
+        except Exception as e:
+            print("Cannot export span:", str(e))
+
+    def summary(self):
+        """Count and p50/p95/p99 latency (ms) of the recent spans of each stage."""
+        with self._lock:
+            snapshot = {name: sorted(durations) for name, durations in self._durations.items()}
+
+        return {
+            name: {
+                "count": len(durations),
+                "p50": Tracer._percentile(durations, 50),
+                "p95": Tracer._percentile(durations, 95),
+                "p99": Tracer._percentile(durations, 99),
+            }
+            for name, durations in snapshot.items()
+            if durations
+        }
+
+    def reset(self):
+        """Forget the recorded durations, e.g. between benchmark scenarios."""
+        with self._lock:
+            self._durations.clear()
+
+    @staticmethod
+    def _percentile(durations, percentile):
+        index = min(len(durations) - 1, round(percentile / 100 * (len(durations) - 1)))
+        return durations[index]
+
+
+def span(name, **attributes):
+    """Trace the enclosed code as a span of the shared tracer."""
+    return Tracer.get_shared().span(name, **attributes)
+
+
+class TracedHTTP:
+    """The `requests` calls the managers make, each traced as an "http" span."""
+
+    def request(self, method, url, **kwargs):
+        with span("http", method=method.upper(), path=urlsplit(url).path) as traced:
+            response = requests.request(method, url, **kwargs)
+            traced.set(status=response.status_code, bytes=len(response.content))
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("post", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("put", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("delete", url, **kwargs)
+
+
+http = TracedHTTP()
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Turn LangChain retriever, chat model and selected chain runs into spans."""
+
+    def __init__(self, tracer, parent=None):
+        self.tracer = tracer
+        self.parent = parent
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, name=None, **kwargs):
+        if name in TRACED_RUNS:
+            self._start(run_id, name)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        attributes = {}
+        if isinstance(outputs, list):
+            attributes["documents"] = len(outputs)
+        elif isinstance(outputs, dict) and "kept_tokens" in outputs:
+            # ContextPacker.pack() output
+            attributes["documents"] = outputs["documents"]
+            attributes["context_tokens"] = outputs["kept_tokens"]
+            attributes["dropped_tokens"] = outputs["dropped_tokens"]
+        self._finish(run_id, **attributes)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=type(error).__name__)
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._start(run_id, "retrieval")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._finish(run_id, documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=type(error).__name__)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, metadata=None, **kwargs):
+        stage = next(
+            (tag.split(":", 1)[1] for tag in tags or [] if tag.startswith("stage:")), "answer")
+        self._start(run_id, f"llm.{stage}", model=(metadata or {}).get("ls_model_name"))
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        with self._lock:
+            span = self._spans.get(run_id)
+        if span is not None and "ttft_ms" not in span.attributes:
+            span.set(ttft_ms=(time.perf_counter() - span.started_at) * 1000)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        attributes = {}
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    attributes["input_tokens"] = usage.get("input_tokens")
+                    attributes["output_tokens"] = usage.get("output_tokens")
+        self._finish(run_id, **attributes)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=type(error).__name__)
+
+    def _start(self, run_id, name, **attributes):
+        with self._lock:
+            self._spans[run_id] = self.tracer.start(name, parent=self.parent, **attributes)
+
+    def _finish(self, run_id, **attributes):
+        with self._lock:
+            span = self._spans.pop(run_id, None)
+        if span is not None:
+            self.tracer.finish(span, **attributes)
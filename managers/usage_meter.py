@@ -0,0 +1,134 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+from .cost_manager import CostManager
+from .text_utils import count_tokens
+
+# the meter of the current turn; registered as a configure hook, so every
+# LangChain run started in this context reports to it (like get_openai_callback)
+usage_meter_var = ContextVar("usage_meter", default=None)
+register_configure_hook(usage_meter_var, True)
+
+# tag prefix naming the pipeline stage of a runnable, e.g. "stage:rewrite"
+STAGE_TAG_PREFIX = "stage:"
+
+# the most recent per-turn usage records of this process
+usage_log = deque(maxlen=1000)
+
+
+class UsageMeter(BaseCallbackHandler):
+    """Collect token usage of one turn per pipeline stage, for every provider.
+
+    Chat model usage is read from the (streaming) `usage_metadata` of each
+    run and attributed to the stage tag of the runnable it ran under. Query
+    embeddings are reported by `CachedEmbeddings` through `record_embedding`
+    with the prompt tokens the embeddings API returns; only stand-in models
+    without usage are counted locally.
+
+    `owner` is the `(username, token)` the turn is billed to, so work it
+    schedules in the background (e.g. history compaction) is billed to the
+    same user.
+    """
+
+    def __init__(self, owner=None):
+        self._lock = threading.Lock()
+        self._runs = {}
+        self.stages = {}
+        self.owner = owner
+
+    @staticmethod
+    @contextmanager
+    def track(owner=None):
+        """Meter the LangChain runs and embeddings of the enclosed turn."""
+        meter = UsageMeter(owner)
+        token = usage_meter_var.set(meter)
+        try:
+            yield meter
+        finally:
+            usage_meter_var.reset(token)
+            usage_log.append(meter.record())
+
+    @staticmethod
+    def current():
+        return usage_meter_var.get()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, metadata=None, **kwargs):
+        self._start(run_id, tags, metadata, serialized)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, tags=None, metadata=None, **kwargs):
+        self._start(run_id, tags, metadata, serialized)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            stage, model = self._runs.pop(run_id, ("answer", None))
+
+        usage = None
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if message is not None and getattr(message, "usage_metadata", None):
+                    usage = message.usage_metadata
+        if usage is None:
+            # providers without streaming usage report it in llm_output
+            token_usage = (response.llm_output or {}).get("token_usage") or {}
+            usage = {
+                "input_tokens": token_usage.get("prompt_tokens", 0),
+                "output_tokens": token_usage.get("completion_tokens", 0),
+            }
+        model = model or (response.llm_output or {}).get("model_name")
+        self._add(stage, model, usage)
+
+    def record_embedding(self, model, texts, tokens=None):
+        if tokens is None:
+            tokens = sum(count_tokens(text) for text in texts)
+        self._add("embedding", model, {"input_tokens": tokens, "output_tokens": 0})
+
+    def record(self):
+        """The usage record of the turn: tokens and cost per stage, and in total."""
+        with self._lock:
+            stages = {stage: dict(usage) for stage, usage in self.stages.items()}
+        return {
+            "stages": stages,
+            "total_cost": sum(usage["cost"] for usage in stages.values()),
+        }
+
+    @property
+    def total_cost(self):
+        return self.record()["total_cost"]
+
+    def _start(self, run_id, tags, metadata, serialized):
+        stage = "answer"
+        for tag in tags or []:
+            if tag.startswith(STAGE_TAG_PREFIX):
+                stage = tag[len(STAGE_TAG_PREFIX):]
+        model = (metadata or {}).get("ls_model_name") or (
+            (serialized or {}).get("kwargs", {}).get("model"))
+        with self._lock:
+            self._runs[run_id] = (stage, model)
+
+    def _add(self, stage, model, usage):
+        details = usage.get("input_token_details") or {}
+        cost = CostManager.calculate_usage_cost(usage, model) if model else 0
+        with self._lock:
+            totals = self.stages.setdefault(stage, {
+                "models": [],
+                "calls": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "cache_read_tokens": 0,
+                "cache_write_tokens": 0,
+                "cost": 0,
+            })
+            if model and model not in totals["models"]:
+                totals["models"].append(model)
+            totals["calls"] += 1
+            totals["input_tokens"] += usage.get("input_tokens", 0)
+            totals["output_tokens"] += usage.get("output_tokens", 0)
+            totals["cache_read_tokens"] += details.get("cache_read") or 0
+            totals["cache_write_tokens"] += details.get("cache_creation") or 0
+            totals["cost"] += cost
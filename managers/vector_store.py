@@ -0,0 +1,402 @@
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import numpy as np
+import streamlit as st
+from pinecone import Pinecone
+
+# metadata fields kept in memory for filtering
+FILTER_FIELDS = ("tag", "name", "page")
+
+
+class VectorIndex(ABC):
+    """Interface of the vector index used by the app.
+
+    It is the subset of the Pinecone `Index` API the managers and
+    `PineconeVectorStore` rely on, so a Pinecone index and LocalVectorIndex
+    are interchangeable. Filters use Pinecone's metadata filter syntax.
+    """
+
+    @abstractmethod
+    def upsert(self, vectors, namespace=None):
+        """Insert or replace `(id, values, metadata)` tuples or `{id, values, metadata}` dicts."""
+
+    @abstractmethod
+    def delete(self, ids=None, namespace=None):
+        """Delete vectors by id."""
+
+    @abstractmethod
+    def fetch(self, ids, namespace=None):
+        """Return `{"namespace", "vectors": {id: {id, values, metadata}}}` for the ids found."""
+
+    @abstractmethod
+    def query(self, vector, top_k, include_metadata=True, namespace=None,
+              filter=None, include_values=False):
+        """Return the `top_k` best `{"id", "score", ...}` matches by dot product."""
+
+    @abstractmethod
+    def describe_index_stats(self):
+        """Return `{"dimension", "namespaces": {name: {"vector_count"}}, "total_vector_count"}`."""
+
+
+class _Namespace:
+    """In-memory view of one namespace: matrix rows, ids and filter fields."""
+
+    def __init__(self, directory, dimension, dtype):
+        self.directory = directory
+        self.dimension = dimension
+        self.dtype = dtype
+        self.matrix = None
+        self.scales = None
+        self.ids = []
+        self.fields = []
+        self.live = np.zeros(0, dtype=bool)
+        self.row_of = {}
+        # per-document row lists, so a name filter only touches its rows
+        self.rows_by_name = {}
+
+    @property
+    def vectors_path(self):
+        return self.directory / "vectors.bin"
+
+    @property
+    def scales_path(self):
+        return self.directory / "scales.bin"
+
+    def remap(self):
+        rows = len(self.ids)
+        if rows == 0:
+            self.matrix, self.scales = None, None
+            return
+        self.matrix = np.memmap(
+            self.vectors_path, dtype=self.dtype, mode="r", shape=(rows, self.dimension))
+        if self.dtype == np.int8:
+            self.scales = np.memmap(
+                self.scales_path, dtype=np.float32, mode="r", shape=(rows,))
+
+
+class LocalVectorIndex(VectorIndex):
+    """Embedded vector index: memory-mapped float32/int8 matrices plus SQLite metadata.
+
+    Rows are appended per namespace, deletes leave tombstones until
+    `compact()` rewrites the files, and queries are brute-force dot products
+    (the metric of the Pinecone index) over the rows that pass the filter.
+    """
+
+    def __init__(self, path, dimension=1536, dtype="float32"):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dimension = dimension
+        self.dtype = np.int8 if dtype == "int8" else np.float32
+        self._lock = threading.RLock()
+        self._namespaces = {}
+        self._conn = sqlite3.connect(self.path / "metadata.sqlite3", check_same_thread=False)
+        self._conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            "namespace TEXT NOT NULL, id TEXT NOT NULL, row INTEGER NOT NULL, "
+            "metadata TEXT NOT NULL, PRIMARY KEY (namespace, id));"
+            "CREATE TABLE IF NOT EXISTS namespaces ("
+            "namespace TEXT PRIMARY KEY, rows INTEGER NOT NULL);"
+        )
+        self._conn.commit()
+        self._load()
+
+    @staticmethod
+    @st.cache_resource
+    def get_shared():
+        """Return the local vector index shared by every session of this process."""
+        config = st.secrets.get("vector_store", {})
+        return LocalVectorIndex(
+            config.get("path", ".cache/vectors"),
+            dimension=config.get("dimension", 1536),
+            dtype=config.get("dtype", "float32")
+        )
+
+    def _load(self):
+        for namespace, rows in self._conn.execute(
+                "SELECT namespace, rows FROM namespaces").fetchall():
+            ns = self._namespace(namespace)
+            ns.ids = [None] * rows
+            ns.fields = [None] * rows
+            ns.live = np.zeros(rows, dtype=bool)
+
+        for namespace, vector_id, row, metadata in self._conn.execute(
+                "SELECT namespace, id, row, metadata FROM vectors"):
+            self._index_row(self._namespaces[namespace], vector_id, row, json.loads(metadata))
+
+        for ns in self._namespaces.values():
+            ns.remap()
+
+    def _namespace(self, namespace):
+        namespace = namespace or ""
+        if namespace not in self._namespaces:
+            # hex-encoding keeps arbitrary tag names safe as directory names
+            directory = self.path / (namespace.encode("utf-8").hex() or "_default")
+            directory.mkdir(parents=True, exist_ok=True)
+            self._namespaces[namespace] = _Namespace(directory, self.dimension, self.dtype)
+        return self._namespaces[namespace]
+
+    @staticmethod
+    def _index_row(ns, vector_id, row, metadata):
+        fields = {field: metadata.get(field) for field in FILTER_FIELDS}
+        ns.ids[row] = vector_id
+        ns.fields[row] = fields
+        ns.live[row] = True
+        ns.row_of[vector_id] = row
+        ns.rows_by_name.setdefault(fields["name"], []).append(row)
+
+    @staticmethod
+    def _unindex_row(ns, vector_id):
+        row = ns.row_of.pop(vector_id)
+        ns.live[row] = False
+        rows = ns.rows_by_name.get(ns.fields[row]["name"])
+        if rows is not None:
+            rows.remove(row)
+        return row
+
+    def upsert(self, vectors, namespace=None):
+        records = [
+            (v["id"], v["values"], v.get("metadata", {})) if isinstance(v, dict) else v
+            for v in vectors
+        ]
+        if not records:
+            return {"upserted_count": 0}
+
+        with self._lock:
+            ns = self._namespace(namespace)
+            matrix = np.asarray([values for _, values, _ in records], dtype=np.float32)
+            if matrix.shape[1] != self.dimension:
+                raise ValueError(
+                    f"Vector dimension {matrix.shape[1]} does not match index dimension {self.dimension}")
+
+            with open(ns.vectors_path, "ab") as f:
+                if self.dtype == np.int8:
+                    scales = np.abs(matrix).max(axis=1) / 127
+                    scales[scales == 0] = 1
+                    f.write(np.round(matrix / scales[:, None]).astype(np.int8).tobytes())
+                    with open(ns.scales_path, "ab") as sf:
+                        sf.write(scales.astype(np.float32).tobytes())
+                else:
+                    f.write(matrix.tobytes())
+
+            start = len(ns.ids)
+            ns.ids.extend([None] * len(records))
+            ns.fields.extend([None] * len(records))
+            ns.live = np.concatenate([ns.live, np.zeros(len(records), dtype=bool)])
+            for offset, (vector_id, _, metadata) in enumerate(records):
+                if vector_id in ns.row_of:
+                    LocalVectorIndex._unindex_row(ns, vector_id)
+                LocalVectorIndex._index_row(ns, vector_id, start + offset, metadata)
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors (namespace, id, row, metadata) VALUES (?, ?, ?, ?)",
+                [
+                    (namespace or "", vector_id, start + offset, json.dumps(metadata, ensure_ascii=False))
+                    for offset, (vector_id, _, metadata) in enumerate(records)
+                ]
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO namespaces (namespace, rows) VALUES (?, ?)",
+                (namespace or "", len(ns.ids))
+            )
+            self._conn.commit()
+            ns.remap()
+
+        return {"upserted_count": len(records)}
+
+    def delete(self, ids=None, namespace=None, delete_all=False):
+        with self._lock:
+            ns = self._namespace(namespace)
+            if delete_all:
+                ids = list(ns.row_of)
+
+            ids = [vector_id for vector_id in ids or [] if vector_id in ns.row_of]
+            for vector_id in ids:
+                LocalVectorIndex._unindex_row(ns, vector_id)
+            self._conn.executemany(
+                "DELETE FROM vectors WHERE namespace = ? AND id = ?",
+                [(namespace or "", vector_id) for vector_id in ids]
+            )
+            self._conn.commit()
+        return {}
+
+    def fetch(self, ids, namespace=None):
+        with self._lock:
+            ns = self._namespace(namespace)
+            found = [(vector_id, ns.row_of[vector_id]) for vector_id in ids if vector_id in ns.row_of]
+            metadata = self._fetch_metadata(namespace, [vector_id for vector_id, _ in found])
+            vectors = {
+                vector_id: {
+                    "id": vector_id,
+                    "values": LocalVectorIndex._row_values(ns.matrix, ns.scales, row).tolist(),
+                    "metadata": metadata[vector_id],
+                }
+                for vector_id, row in found
+            }
+        return {"namespace": namespace or "", "vectors": vectors}
+
+    def query(self, vector, top_k, include_metadata=True, namespace=None,
+              filter=None, include_values=False):
+        # snapshot the rows under the lock and score them outside it, so
+        # concurrent queries and upserts do not wait on each other's math;
+        # rows are append-only and the memory maps stay valid after a remap
+        with self._lock:
+            ns = self._namespace(namespace)
+            matrix, scales = ns.matrix, ns.scales
+            rows = self._candidate_rows(ns, filter) if matrix is not None else []
+        if len(rows) == 0:
+            return {"namespace": namespace or "", "matches": []}
+
+        query = np.asarray(vector, dtype=np.float32)
+        scores = matrix[rows].astype(np.float32) @ query
+        if scales is not None:
+            scores *= scales[rows]
+
+        k = min(top_k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        with self._lock:
+            # drop rows deleted or replaced since the snapshot
+            matched = [
+                (ns.ids[row], row, score)
+                for row, score in zip(rows[top], scores[top])
+                if ns.row_of.get(ns.ids[row]) == row
+            ]
+            metadata = self._fetch_metadata(
+                namespace, [vector_id for vector_id, _, _ in matched]) if include_metadata else {}
+
+        matches = []
+        for vector_id, row, score in matched:
+            match = {"id": vector_id, "score": float(score)}
+            if include_metadata:
+                match["metadata"] = metadata[vector_id]
+            if include_values:
+                match["values"] = LocalVectorIndex._row_values(matrix, scales, row).tolist()
+            matches.append(match)
+
+        return {"namespace": namespace or "", "matches": matches}
+
+    def describe_index_stats(self):
+        with self._lock:
+            namespaces = {
+                name: {"vector_count": len(ns.row_of)}
+                for name, ns in self._namespaces.items()
+            }
+        return {
+            "dimension": self.dimension,
+            "namespaces": namespaces,
+            "total_vector_count": sum(ns["vector_count"] for ns in namespaces.values()),
+        }
+
+    def compact(self, namespace=None):
+        """Rewrite a namespace's files without the rows of deleted vectors."""
+        with self._lock:
+            ns = self._namespace(namespace)
+            live_ids = list(ns.row_of)
+            values = [
+                LocalVectorIndex._row_values(ns.matrix, ns.scales, ns.row_of[vector_id])
+                for vector_id in live_ids
+            ]
+            metadata = self._fetch_metadata(namespace, live_ids)
+
+            ns.matrix, ns.scales = None, None
+            ns.vectors_path.unlink(missing_ok=True)
+            ns.scales_path.unlink(missing_ok=True)
+            self._conn.execute(
+                "DELETE FROM vectors WHERE namespace = ?", (namespace or "",))
+            self._conn.execute(
+                "DELETE FROM namespaces WHERE namespace = ?", (namespace or "",))
+            self._conn.commit()
+            del self._namespaces[namespace or ""]
+
+            self.upsert(
+                [(vector_id, value, metadata[vector_id])
+                 for vector_id, value in zip(live_ids, values)],
+                namespace=namespace
+            )
+
+    @staticmethod
+    def _row_values(matrix, scales, row):
+        values = np.asarray(matrix[row], dtype=np.float32)
+        if scales is not None:
+            values = values * scales[row]
+        return values
+
+    def _fetch_metadata(self, namespace, ids):
+        metadata = {}
+        # stay below SQLite's bound-parameter limit
+        for i in range(0, len(ids), 500):
+            batch = ids[i: i + 500]
+            rows = self._conn.execute(
+                "SELECT id, metadata FROM vectors WHERE namespace = ? "
+                f"AND id IN ({','.join('?' * len(batch))})",
+                [namespace or ""] + batch
+            ).fetchall()
+            metadata.update({vector_id: json.loads(value) for vector_id, value in rows})
+        return metadata
+
+    @staticmethod
+    def _candidate_rows(ns, filter):
+        filter = dict(filter or {})
+        name_condition = filter.get("name")
+        if isinstance(name_condition, dict) and set(name_condition) == {"$in"}:
+            # fast path: gather the row ranges of the selected documents
+            filter.pop("name")
+            rows = [
+                row for name in name_condition["$in"]
+                for row in ns.rows_by_name.get(name, [])
+            ]
+            rows = np.asarray(sorted(rows), dtype=np.int64)
+        else:
+            rows = np.flatnonzero(ns.live)
+
+        if filter:
+            rows = np.asarray(
+                [row for row in rows if LocalVectorIndex._matches(ns.fields[row], filter)],
+                dtype=np.int64
+            )
+        return rows
+
+    @staticmethod
+    def _matches(fields, filter):
+        for field, condition in filter.items():
+            if field == "$and":
+                if not all(LocalVectorIndex._matches(fields, c) for c in condition):
+                    return False
+                continue
+            if field == "$or":
+                if not any(LocalVectorIndex._matches(fields, c) for c in condition):
+                    return False
+                continue
+            if field not in FILTER_FIELDS:
+                raise ValueError(f"Unsupported filter field: {field}")
+
+            value = fields[field]
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for op, operand in condition.items():
+                if op == "$eq" and value != operand:
+                    return False
+                if op == "$ne" and value == operand:
+                    return False
+                if op == "$in" and value not in operand:
+                    return False
+                if op == "$nin" and value in operand:
+                    return False
+                if op not in ("$eq", "$ne", "$in", "$nin"):
+                    raise ValueError(f"Unsupported filter operator: {op}")
+        return True
+
+
+def get_vector_index(index_name):
+    """Return the configured vector index: the local backend or a Pinecone index."""
+    if st.secrets.get("vector_store", {}).get("backend", "pinecone") == "local":
+        return LocalVectorIndex.get_shared()
+
+    pc = Pinecone(api_key=st.secrets["PINECONE_API_KEY"])
+    return pc.Index(index_name)